@@ -1,36 +1,93 @@
 import datetime
 from light import Light
+import metrics
+
+# How the lights look in each state, unless configured otherwise.
+#  brightness_per_failure - added to the brightness per failed job after the first
+#  effect                 - 'none', 'pulse' or 'breathe' (see effects.EffectEngine)
+#  period                 - seconds per effect cycle
+DEFAULT_PALETTE = {
+    'ok' : { 'color' : 'white', 'brightness' : 180 },
+    'failed' : { 'color' : 'red', 'brightness' : 240 },
+    'claimed' : { 'color' : 'orange', 'brightness' : 240 },
+}
+
+def make_palette(palette_cfg=None):
+    """
+    Returns the default palette with the configured values of each state applied.
+    """
+    palette_cfg = palette_cfg or {}
+    return { state : dict(look, **palette_cfg.get(state, {})) for state, look in DEFAULT_PALETTE.items() }
+
 
 class Alert():
-    def __init__(self, lights, jobs, allow_nr_failed_jobs=0):
+    def __init__(self, lights, jobs, allow_nr_failed_jobs=0, palette=None, effects=None):
         self.name = ",".join([job.name for job in jobs])
         self.jobs = jobs
         self.lights = lights
         self.last_status = None
         self.first_update = True
         self._allow_nr_failed_jobs = allow_nr_failed_jobs
-        
+        self._palette = palette or make_palette()
+        self._effects = effects
+        # failed jobs and the failed jobs that are not claimed, by id
+        self._failed = {}
+        self._non_claimed_failed = {}
+        for job in jobs:
+            self.job_changed(job)
+
     def __str__(self):
         jobs = ",".join([job.name for job in self.jobs])
         lights = ",".join([light.name for light in self.lights])
         return "Alert: {lights} is showing status from {numjobs} jobs allowing {fails} fails".format(
             numjobs=len(self.jobs), lights=lights, fails=self._allow_nr_failed_jobs)
 
-    def update(self):
-        for job in self.jobs:
-            job.update()
+    def restore_status(self, status):
+        """
+        Continues from a status shown earlier, so that the first evaluation
+        only flashes the lights if the status is different.
+        """
+        self.last_status = status
+        self.first_update = False
+
+    def job_changed(self, job):
+        """
+        Updates the failed job bookkeeping from the current state of job.
+        Must be called when the state of one of the jobs has changed.
+        """
+        key = id(job)
+        self._failed.pop(key, None)
+        self._non_claimed_failed.pop(key, None)
+        if not job.ok(allow_nr_failed_jobs=self._allow_nr_failed_jobs):
+            self._failed[key] = job
+            if not job.claimed:
+                self._non_claimed_failed[key] = job
+
+    def evaluate(self):
+        """
+        Sets the lights from the current state of the jobs, without
+        fetching anything from jenkins.
+        """
+        with metrics.alert_evaluate_seconds.time():
+            self._evaluate()
+
+    def _evaluate(self):
         ok = self._ok()
         
         if ok:
-            color = 'white'
-            brightness = 180
+            state = 'ok'
+        elif self._all_failures_claimed():
+            state = 'claimed'
         else:
-            color = 'red'
-            brightness = 240
-            if self._all_failures_claimed():
-                color = 'orange'
+            state = 'failed'
+        look = self._palette[state]
+        color = look['color']
+        # severity ramp
+        extra_failures = max(0, len(self._failed) - 1)
+        brightness = min(254, look['brightness'] + look.get('brightness_per_failure', 0) * extra_failures)
 
         self._set_lights_output(color, brightness)
+        self._set_lights_effect(look.get('effect', 'none'), brightness, look.get('period', 2))
         if self._has_changed((ok, color)):
             if not self.first_update:
                 self._do_flash()
@@ -44,6 +101,7 @@ class Alert():
             if not self._all_failures_claimed():
                 print("Non claimed failed jobs: {}".format(",".join([job.name for job in self._all_non_claimed_failed_jobs()])))
 
+        self._commit_lights()
         self.first_update = False
 
     def _set_lights_output(self, color, brightness):
@@ -51,9 +109,19 @@ class Alert():
             light.color = color
             light.brightness = brightness
         
+    def _set_lights_effect(self, effect, brightness, period):
+        if not self._effects:
+            return
+        for light in self.lights:
+            self._effects.set(light, effect, brightness, period)
+
     def _do_flash(self):
         for light in self.lights:
             light.flash()
+
+    def _commit_lights(self):
+        for light in self.lights:
+            light.commit()
             
     def _has_changed(self, a_hash):
         changed = self.last_status != a_hash
@@ -61,13 +129,13 @@ class Alert():
         return changed
             
     def _ok(self):
-        return not self._failed_jobs()
+        return not self._failed
 
     def _failed_jobs(self):
-        return list(filter(lambda j : not j.ok(allow_nr_failed_jobs=self._allow_nr_failed_jobs), self.jobs))
+        return list(self._failed.values())
     
     def _all_failures_claimed(self):
-        return not self._all_non_claimed_failed_jobs()
+        return not self._non_claimed_failed
 
     def _all_non_claimed_failed_jobs(self):
-        return list(filter(lambda job : not job.claimed, self._failed_jobs()))
+        return list(self._non_claimed_failed.values())
@@ -0,0 +1,410 @@
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import unquote
+from hue_light import HueLightController
+from jenkins_source import MAX_BUILDS
+from runner import Runner
+
+# Each team has an alert on a lamp of its own, watching the jobs of the team
+NR_TEAMS = 10
+
+class FakeJenkins():
+    """
+    Serves the api data of nr_jobs generated jobs, and of nr_views views over
+    them, from an http server in this process. Requests are answered after
+    latency seconds, a failure_rate share of them with a 500 error.
+    """
+    def __init__(self, nr_jobs, nr_views=0, latency=0, failure_rate=0,
+                 builds_per_job=20, seed=0):
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        # (etag, body) by path and whether build data was asked for
+        self._bodies = {}
+        self._requests = 0
+        self.jobs = {}
+        now = time.time()
+        for i in range(nr_jobs):
+            last = self._random.randint(builds_per_job, 1000)
+            job = {
+                'first' : last - builds_per_job + 1,
+                'last' : last,
+                'last_failed' : None,
+                'last_stable' : last,
+                'claimed' : False,
+                'time' : now - self._random.uniform(0, 7 * 24 * 3600),
+            }
+            if self._random.random() < 0.1:
+                self._new_build(job, now)
+            self.jobs['team{:02}-job{:05}'.format(i % NR_TEAMS, i)] = job
+        names = sorted(self.jobs)
+        self.views = { 'view{}'.format(v) : names[v::nr_views] for v in range(nr_views) }
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def advance(self, change_rate):
+        """
+        Completes a new build of a change_rate share of the jobs.
+        """
+        now = time.time()
+        with self._lock:
+            for job in self._random.sample(list(self.jobs.values()), int(len(self.jobs) * change_rate)):
+                self._new_build(job, now)
+            self._bodies.clear()
+
+    def take_requests(self):
+        """
+        Returns the number of requests since last time.
+        """
+        with self._lock:
+            requests, self._requests = self._requests, 0
+        return requests
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _new_build(self, job, now):
+        job['first'] += 1
+        job['last'] += 1
+        job['time'] = now
+        if self._random.random() < 0.3:
+            job['last_failed'] = job['last']
+            job['claimed'] = self._random.random() < 0.5
+        else:
+            job['last_stable'] = job['last']
+            job['claimed'] = False
+
+    def _body(self, path, with_builds):
+        key = (path, with_builds)
+        with self._lock:
+            self._requests += 1
+            if key not in self._bodies:
+                data = self._data([part for part in path.split('/') if part], with_builds)
+                if data is None:
+                    return None
+                body = json.dumps(data).encode('utf-8')
+                self._bodies[key] = ('"{}"'.format(hashlib.sha1(body).hexdigest()), body)
+            return self._bodies[key]
+
+    def _data(self, parts, with_builds):
+        if parts[-2:] != ['api', 'json']:
+            return None
+        parts = parts[:-2]
+        if not parts:
+            if with_builds:
+                return { 'jobs' : [self._job_data(name, bulk=True) for name in self.jobs] }
+            return { 'jobs' : [self._listing(name) for name in self.jobs],
+                     'views' : [{ 'name' : view, 'url' : '{}/view/{}/'.format(self.url, view) }
+                                for view in self.views] }
+        if parts[0] == 'view' and len(parts) == 2 and parts[1] in self.views:
+            return { 'jobs' : [self._listing(name) for name in self.views[parts[1]]] }
+        if parts[0] == 'job' and len(parts) in (2, 3) and parts[1] in self.jobs:
+            if len(parts) == 2:
+                return self._job_data(parts[1])
+            job = self.jobs[parts[1]]
+            return { 'number' : int(parts[2]), 'timestamp' : int(job['time'] * 1000),
+                     'actions' : [{}, { 'claimed' : job['claimed'] }] }
+        return None
+
+    def _listing(self, name):
+        job = self.jobs[name]
+        return { 'name' : name, 'url' : '{}/job/{}/'.format(self.url, name),
+                 'color' : 'red' if job['last_failed'] == job['last'] else 'blue' }
+
+    def _job_data(self, name, bulk=False):
+        job = self.jobs[name]
+        number = lambda nr: { 'number' : nr } if nr else None
+        last_completed = { 'number' : job['last'], 'timestamp' : int(job['time'] * 1000) }
+        if bulk:
+            last_completed['actions'] = [{}, { 'claimed' : job['claimed'] }]
+        else:
+            last_completed['url'] = '{}/job/{}/{}/'.format(self.url, name, job['last'])
+        data = self._listing(name)
+        data.update({
+            # the projection of the requested trees, see jenkins_source
+            'builds' : [{ 'number' : job['last'] - MAX_BUILDS + 1 }] if job['last'] - job['first'] >= MAX_BUILDS - 1 else [],
+            'firstBuild' : { 'number' : job['first'] },
+            'lastFailedBuild' : number(job['last_failed']),
+            'lastStableBuild' : number(job['last_stable']),
+            'lastCompletedBuild' : last_completed,
+        })
+        return data
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if fake._latency:
+                    time.sleep(fake._latency)
+                if fake._failure_rate:
+                    with fake._lock:
+                        failed = fake._random.random() < fake._failure_rate
+                        if failed:
+                            fake._requests += 1
+                    if failed:
+                        self.send_error(500)
+                        return
+                path, _, query = self.path.partition('?')
+                found = fake._body(path, 'lastCompletedBuild' in unquote(query))
+                if found is None:
+                    self.send_error(404)
+                    return
+                etag, body = found
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeHueBridge():
+    """
+    Stands in for a phue Bridge with a light per name. Like a real bridge it
+    handles about light_rate light commands and group_rate group commands
+    per second, commands beyond that are answered with an error and dropped.
+    """
+    def __init__(self, light_names, light_rate=10, group_rate=1):
+        self.username = 'benchmark'
+        self._lights = { str(i + 1) : {
+            'name' : name,
+            'type' : 'Extended color light',
+            'modelid' : 'LCT015',
+            'state' : { 'on' : True, 'bri' : 254, 'reachable' : True, 'xy' : [0.3, 0.3], 'ct' : 300 },
+        } for i, name in enumerate(light_names) }
+        self._groups = {}
+        # [commands per second, commands left, time.monotonic() when counted]
+        self._budgets = { 'light' : [light_rate, light_rate, time.monotonic()],
+                          'group' : [group_rate, group_rate, time.monotonic()] }
+        self._lock = Lock()
+        self._commands = 0
+        self._dropped = 0
+        self.reads = 0
+
+    def take_commands(self):
+        """
+        Returns the number of commands handled and dropped since last time.
+        """
+        with self._lock:
+            commands = (self._commands, self._dropped)
+            self._commands = self._dropped = 0
+        return commands
+
+    def get_light(self, light_id=None, parameter=None):
+        with self._lock:
+            self.reads += 1
+            if light_id is None:
+                return copy.deepcopy(self._lights)
+            light = self._lights[str(light_id)]
+            if parameter is None:
+                return copy.deepcopy(light)
+            return light.get(parameter, light['state'].get(parameter))
+
+    def set_light(self, light_id, parameter, value=None, transitiontime=None):
+        state = parameter if isinstance(parameter, dict) else { parameter : value }
+        if not self._take('light'):
+            return [[self._overloaded()]]
+        with self._lock:
+            self._set_state(self._lights[str(light_id)], state)
+        return [[{ 'success' : state }]]
+
+    def get_group(self, group_id=None, parameter=None):
+        with self._lock:
+            self.reads += 1
+            if group_id is None:
+                return copy.deepcopy(self._groups)
+            return copy.deepcopy(self._groups[str(group_id)])
+
+    def create_group(self, name, lights):
+        with self._lock:
+            gid = str(len(self._groups) + 1)
+            self._groups[gid] = { 'name' : name, 'lights' : [str(lid) for lid in lights] }
+        return [{ 'success' : { 'id' : gid } }]
+
+    def set_group(self, group_id, parameter, value=None, transitiontime=None):
+        state = parameter if isinstance(parameter, dict) else { parameter : value }
+        if not self._take('group'):
+            return [[self._overloaded()]]
+        with self._lock:
+            for lid in self._groups[str(group_id)]['lights']:
+                self._set_state(self._lights[lid], state)
+        return [[{ 'success' : state }]]
+
+    def _set_state(self, light, state):
+        light['state'].update((key, value) for key, value in state.items()
+                              if key not in ('alert', 'transitiontime'))
+
+    def _take(self, kind):
+        now = time.monotonic()
+        with self._lock:
+            budget = self._budgets[kind]
+            budget[1] = min(budget[0], budget[1] + (now - budget[2]) * budget[0])
+            budget[2] = now
+            if budget[1] < 1:
+                self._dropped += 1
+                return False
+            budget[1] -= 1
+            self._commands += 1
+            return True
+
+    def _overloaded(self):
+        return { 'error' : { 'type' : 901, 'description' : 'Internal error, 503' } }
+
+
+def run(nr_jobs, args, poll):
+    """
+    Starts a Runner against fake servers with nr_jobs jobs and returns the
+    requests made at startup, the peak traced memory of startup and the
+    first poll cycle, and (seconds, requests, bridge commands, dropped
+    commands) of each following cycle.
+
+    With poll 'all' a cycle is one update_alerts() call. With poll 'due' a
+    cycle runs the loop of the daemon for poll_interval seconds, polling
+    the jobs the poll scheduler finds due, and its seconds are the time
+    spent in update_due_jobs().
+    """
+    jenkins = FakeJenkins(nr_jobs, args.views, args.latency, args.failure_rate)
+    lights = ['lamp{}'.format(team) for team in range(NR_TEAMS)] + \
+             ['lamp-{}'.format(view) for view in jenkins.views]
+    bridge = FakeHueBridge(lights)
+    cfg = { 'alerts' : [{ 'jobs_to_watch' : ['team{:02}-.*'.format(team)], 'light' : 'lamp{}'.format(team) }
+                        for team in range(NR_TEAMS)] +
+                       [{ 'jobs_to_watch' : [view], 'light' : 'lamp-{}'.format(view) }
+                        for view in jenkins.views] }
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as cfg_file:
+        json.dump(cfg, cfg_file)
+    controller = None
+    try:
+        with _output(args.verbose):
+            tracemalloc.start()
+            controller = HueLightController(None, bridge=bridge)
+            runner = Runner(cfg_file.name, None, [jenkins.url],
+                            max_requests_per_host=args.max_requests_per_host,
+                            bulk_fetch=args.bulk_fetch, poll_interval=args.poll_interval,
+                            max_poll_interval=args.max_poll_interval,
+                            max_requests_per_second=args.max_requests_per_second,
+                            hue_controller=controller)
+            startup_requests = jenkins.take_requests()
+            # the first cycle also fetches the last build of every job, all
+            # jobs are due right after startup
+            if poll == 'all':
+                runner.update_alerts()
+            else:
+                runner.update_due_jobs()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            controller.flush()
+            jenkins.take_requests()
+            bridge.take_commands()
+
+            cycles = []
+            for _ in range(args.cycles):
+                jenkins.advance(args.change_rate)
+                if poll == 'all':
+                    start = time.perf_counter()
+                    runner.update_alerts()
+                    duration = time.perf_counter() - start
+                else:
+                    duration = _poll_due_jobs(runner, args.poll_interval)
+                controller.flush()
+                cycles.append((duration, jenkins.take_requests()) + bridge.take_commands())
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if controller:
+            controller.close()
+        jenkins.close()
+        os.unlink(cfg_file.name)
+    return startup_requests, peak, cycles
+
+
+def _poll_due_jobs(runner, seconds):
+    """
+    Runs the poll loop of the daemon for seconds and returns the seconds
+    spent polling.
+    """
+    end = time.monotonic() + seconds
+    busy = 0
+    while True:
+        start = time.perf_counter()
+        runner.update_due_jobs()
+        busy += time.perf_counter() - start
+        left = end - time.monotonic()
+        if left <= 0:
+            return busy
+        runner.wait_for_due_jobs(left)
+
+
+@contextlib.contextmanager
+def _output(verbose):
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures team-alert poll cycles against a fake jenkins and hue bridge. "
+                                     "Peak memory is traced for the whole process, fake servers included.")
+    parser.add_argument("--jobs", nargs='+', type=int, default=[10, 100, 1000, 10000], help="job counts to measure")
+    parser.add_argument("--views", default=0, type=int, help="number of views over the jobs, each with an alert of its own")
+    parser.add_argument("--latency", default=0, type=float, help="seconds before the fake jenkins answers a request")
+    parser.add_argument("--failure_rate", default=0, type=float, help="share of requests the fake jenkins fails")
+    parser.add_argument("--change_rate", default=0.01, type=float, help="share of the jobs with a new build each cycle")
+    parser.add_argument("--cycles", default=3, type=int, help="poll cycles to measure after the first one")
+    parser.add_argument("--max_requests_per_host", default=4, type=int)
+    parser.add_argument("--bulk_fetch", action='store_true')
+    parser.add_argument("--poll", nargs='+', choices=['due', 'all'], default=['due', 'all'],
+                        help="poll the jobs the poll scheduler finds due, as the daemon does, and/or all jobs each cycle")
+    parser.add_argument("--poll_interval", default=1, type=float, help="fastest poll interval and the length of a 'due' cycle")
+    parser.add_argument("--max_poll_interval", default=60, type=float, help="slowest poll interval of idle jobs")
+    parser.add_argument("--max_requests_per_second", default=None, type=float)
+    parser.add_argument("--verbose", action='store_true', help="show the output of team-alert")
+    args = parser.parse_args()
+
+    print("views={} latency={} failure_rate={} change_rate={} max_requests_per_host={} bulk_fetch={} "
+          "poll_interval={} max_poll_interval={} max_requests_per_second={}".format(
+          args.views, args.latency, args.failure_rate, args.change_rate,
+          args.max_requests_per_host, args.bulk_fetch, args.poll_interval,
+          args.max_poll_interval, args.max_requests_per_second))
+    print("{:>4} {:>7} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+          "poll", "jobs", "startup req", "cycle s", "req/cycle", "cmds/cycle", "dropped", "peak MiB"))
+    for poll in args.poll:
+        for nr_jobs in args.jobs:
+            startup_requests, peak, cycles = run(nr_jobs, args, poll)
+            average = lambda i: sum(cycle[i] for cycle in cycles) / max(1, len(cycles))
+            print("{:>4} {:>7} {:>12} {:>10.3f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                  poll, nr_jobs, startup_requests, average(0), average(1), average(2), average(3),
+                  peak / 2 ** 20), flush=True)
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import time
+from threading import Condition, Thread
+
+EFFECTS = ('none', 'pulse', 'breathe')
+
+class EffectEngine():
+    """
+    Animates lights by alternating their brightness between the brightness
+    they were given and a dimmed level, every half period.
+
+    Each frame is a single command with a Hue transition time, so the fade
+    itself is done by the bridge: 'breathe' fades over the whole half
+    period and 'pulse' changes quickly. At most max_frame_rate frames are
+    sent per second for all lights together; frames beyond that are delayed.
+    """
+    DIM_FACTOR = 0.25
+    PULSE_TRANSITION = 0.2
+    MIN_PERIOD = 1
+
+    def __init__(self, max_frame_rate=4, lock=None):
+        self._min_frame_interval = 1.0 / max_frame_rate
+        self._lock = lock
+        # id(light) -> [light, effect, brightness, period, dimmed, generation]
+        self._effects = {}
+        self._deadlines = []
+        self._generation = itertools.count()
+        self._last_frame = 0
+        self._closed = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set(self, light, effect, brightness, period=2):
+        """
+        Runs effect on light around brightness. Setting the same effect again
+        keeps the animation going as it is. Lights that do not support
+        effects are left alone.
+        """
+        if effect not in EFFECTS:
+            raise ValueError("Unknown effect {}".format(effect))
+        if not light.supports_effects:
+            return
+        period = max(period, self.MIN_PERIOD)
+        with self._cond:
+            current = self._effects.get(id(light))
+            if effect == 'none':
+                self._effects.pop(id(light), None)
+                return
+            if current and current[1:4] == [effect, brightness, period]:
+                return
+            generation = next(self._generation)
+            self._effects[id(light)] = [light, effect, brightness, period, False, generation]
+            heapq.heappush(self._deadlines, (time.monotonic() + period / 2, generation, id(light)))
+            self._cond.notify_all()
+
+    def clear(self, light):
+        self.set(light, 'none', 0)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.monotonic()
+                    if self._deadlines and self._deadlines[0][0] <= now:
+                        break
+                    timeout = self._deadlines[0][0] - now if self._deadlines else None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                deadline, generation, key = heapq.heappop(self._deadlines)
+                entry = self._effects.get(key)
+                if not entry or entry[5] != generation:
+                    # replaced or removed since it was scheduled
+                    continue
+                entry[4] = not entry[4]
+                light, effect, brightness, period, dimmed, _ = entry
+                # drift free, but never faster than the frame rate allows
+                next_frame = max(deadline + period / 2, now + self._min_frame_interval)
+                heapq.heappush(self._deadlines, (next_frame, generation, key))
+
+            wait = self._last_frame + self._min_frame_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_frame = time.monotonic()
+            self._frame(light, effect, brightness, period, dimmed, generation)
+
+    def _frame(self, light, effect, brightness, period, dimmed, generation):
+        level = max(1, int(brightness * self.DIM_FACTOR)) if dimmed else brightness
+        transition = period / 2 if effect == 'breathe' else self.PULSE_TRANSITION
+        if self._lock:
+            with self._lock:
+                self._send(light, level, transition, generation)
+        else:
+            self._send(light, level, transition, generation)
+
+    def _send(self, light, level, transition, generation):
+        with self._cond:
+            entry = self._effects.get(id(light))
+            if not entry or entry[5] != generation:
+                # the effect was changed while waiting for the frame
+                return
+        light.brightness = level
+        light.transition(transition)
+        light.commit()
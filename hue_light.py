@@ -1,13 +1,221 @@
 from phue import Bridge, PhueRegistrationException
-from rgb_cie import Converter
+from rgb_cie import Converter, gamut_for_model, DEFAULT_GAMUT
+from functools import lru_cache
 from light import Light, LightController
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
 import datetime
 import socket
 import argparse
+import time
+import metrics
+
+COLORS_RGB = {
+    'red': (1, 0, 0),
+    'green': (0, 1, 0),
+    'blue': (0, 0, 1),
+    'yellow': (1, 1, 0),
+    'orange': (1, 0.49, 0),
+}
+
+WHITE_CT = 353
+
+
+@lru_cache(maxsize=None)
+def color_table(gamut):
+    """
+    The colors a light can be set to, for a color gamut. Computed once per gamut
+    and shared by all lights.
+    """
+    names = list(COLORS_RGB)
+    xys = Converter(gamut).rgbListToCIE1931([COLORS_RGB[name] for name in names])
+    colors = { name : (xy, 'xy') for name, xy in zip(names, xys) }
+    colors['white'] = (WHITE_CT, 'ct')
+    return colors
+
+
+@lru_cache(maxsize=256)
+def hex_color(gamut, color):
+    """
+    Returns the color entry for a '#rrggbb' color, None if it is not one.
+    """
+    if len(color) != 7 or not color.startswith('#'):
+        return None
+    try:
+        return (Converter(gamut).hexToCIE1931(color[1:]), 'xy')
+    except ValueError:
+        return None
+
+
+# Prefix of the names of bridge groups created for alerts with several lights
+GROUP_NAME_PREFIX = 'alert:'
+
+def failed_attributes(result, state):
+    """
+    Returns the attributes of state that a set_light or set_group result
+    reports errors for. phue returns the errors of the bridge, it does not
+    raise them.
+    """
+    failed = set()
+    for response in result if isinstance(result, list) else []:
+        for item in response if isinstance(response, list) else [response]:
+            error = item.get('error') if isinstance(item, dict) else None
+            if error:
+                key = str(error.get('address', '')).rsplit('/', 1)[-1]
+                if key not in state:
+                    # not about a single attribute, e.g. the bridge is busy
+                    return set(state)
+                failed.add(key)
+    return failed
+
+class BridgeCommandQueue():
+    """
+    Sends light commands to the bridge from a background thread, limited by
+    a token bucket to rate commands per second with bursts of up to burst
+    commands. Commands for a light that are still waiting to be sent are
+    merged, so only the latest state of each light is sent. on_failed of a
+    command is called with the attributes that could not be set.
+
+    The bridge handles about one group command per second, so a group
+    command costs as much as group_cost light commands.
+    """
+    def __init__(self, bridge, rate=10, burst=10, group_cost=10, on_sent=None):
+        self._bridge = bridge
+        self._group_cost = group_cost
+        self._on_sent = on_sent
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._pending = OrderedDict()
+        self._on_failed = {}
+        self._in_flight = 0
+        self._closed = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, lid, state, on_failed=None):
+        self._put(('light', lid), state, on_failed)
+
+    def put_group(self, gid, state, on_failed=None):
+        self._put(('group', gid), state, on_failed)
+
+    def _put(self, key, state, on_failed):
+        with self._cond:
+            self._on_failed[key] = on_failed
+            pending = self._pending.setdefault(key, {})
+            # only one of the color spaces can be in effect
+            if 'xy' in state:
+                pending.pop('ct', None)
+            if 'ct' in state:
+                pending.pop('xy', None)
+            pending.update(state)
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued commands are sent.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._in_flight, timeout)
+
+    def close(self):
+        """
+        Stops the background thread once the queued commands are sent.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                (kind, target), state = self._pending.popitem(last=False)
+                on_failed = self._on_failed.pop((kind, target), None)
+                self._in_flight += 1
+            failed = set(state)
+            try:
+                if kind == 'group':
+                    self._take_tokens(self._group_cost)
+                    result = self._bridge.set_group(target, state)
+                else:
+                    self._take_tokens(1)
+                    result = self._bridge.set_light(target, state)
+                metrics.bridge_commands.inc(kind=kind)
+                failed = failed_attributes(result, state)
+                if failed:
+                    print("ERROR: Failed to set {} of {} {}: {}".format(
+                          ",".join(sorted(failed)), kind, target, result))
+            except Exception as err:
+                # keep the queue running whatever the bridge or network does
+                print("ERROR: Failed to set {} {}: {}".format(kind, target, err))
+            if failed:
+                metrics.bridge_errors.inc()
+                if on_failed:
+                    on_failed(failed)
+            if self._on_sent:
+                self._on_sent()
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _take_tokens(self, count):
+        count = min(count, self._burst)
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self._rate)
+            self._refilled = now
+            if self._tokens >= count:
+                self._tokens -= count
+                return
+            time.sleep((count - self._tokens) / self._rate)
+
+
+class LightStateCache():
+    """
+    State of all lights on the bridge, read with a single request and kept
+    for ttl seconds or until invalidated.
+    """
+    # attributes on the light itself, everything else is in its 'state'
+    LIGHT_ATTRIBUTES = ('name', 'type', 'modelid', 'uniqueid', 'swversion', 'capabilities')
+
+    def __init__(self, bridge, ttl=5):
+        self._bridge = bridge
+        self._ttl = ttl
+        self._lights = None
+        self._fetched = None
+        self._lock = Lock()
+
+    def lights(self):
+        with self._lock:
+            if self._lights is None or time.monotonic() - self._fetched >= self._ttl:
+                self._lights = self._bridge.get_light()
+                self._fetched = time.monotonic()
+            return self._lights
+
+    def get(self, lid, key):
+        light = self.lights()[str(lid)]
+        if key in self.LIGHT_ATTRIBUTES:
+            return light[key]
+        return light['state'][key]
+
+    def invalidate(self):
+        with self._lock:
+            self._lights = None
+
 
 class HueLight(Light):
-    def __init__(self, associated_bridge, bridge_light_id):
+    supports_effects = True
+
+    def __init__(self, associated_bridge, bridge_light_id, command_queue=None,
+                 state_cache=None):
         self._bridge = associated_bridge
+        self._command_queue = command_queue
+        self._state_cache = state_cache
         self.lid = bridge_light_id
         self._name = self._get('name')
         self._create_colors()
@@ -15,17 +223,27 @@ class HueLight(Light):
         self._brightness = self._get('bri')
         self._reachable = None
         self._on = self._get('on')
+        # state last sent to the bridge, state waiting to be sent by commit()
+        # and the state the light should be in
+        self._sent = {'on' : self._on, 'bri' : self._brightness}
+        self._pending = {}
+        self._wanted = {}
         
     def _create_colors(self):
-        c = Converter()
-        self.colors = {
-            'red': (c.rgbToCIE1931(1,0,0), 'xy'),
-            'green': (c.rgbToCIE1931(0,1,0), 'xy'),
-            'blue': (c.rgbToCIE1931(0,0,1), 'xy'),
-            'yellow': (c.rgbToCIE1931(1,1,0), 'xy'),
-            'orange': (c.rgbToCIE1931(1,0.49,0), 'xy'),
-            'white': (353, 'ct')
-            }
+        self.gamut = self._gamut()
+        self.colors = color_table(self.gamut)
+
+    def _gamut(self):
+        try:
+            gamut = self._get('capabilities')['control']['colorgamuttype']
+            if gamut in ('A', 'B', 'C'):
+                return gamut
+        except (KeyError, TypeError):
+            pass
+        try:
+            return gamut_for_model(self._get('modelid'))
+        except KeyError:
+            return DEFAULT_GAMUT
         
     def __str__(self):
         return "{:<30}{:<20}".format(self.name, "yes" if self.reachable else "no")
@@ -48,7 +266,7 @@ class HueLight(Light):
 
     @property
     def reachable(self):
-        return self._bridge.get_light(self.lid, 'reachable')
+        return self._get('reachable')
 
     @name.setter
     def name(self, value):
@@ -59,10 +277,10 @@ class HueLight(Light):
 
     @color.setter
     def color(self, color):
-        if color in self.colors:
-            colorspace = self.colors[color][1]
-            value = self.colors[color][0]
-            self._set(colorspace, value)
+        entry = self.colors.get(color) or hex_color(self.gamut, color)
+        if entry:
+            value, colorspace = entry
+            self._stage(colorspace, value)
             self._color = color
         else:
             print("ERROR: Unknown color")
@@ -72,43 +290,206 @@ class HueLight(Light):
         if value > 254:
             value = 254
         self._brightness = value
-        self._set('on', (value > 0))
-        if self.on:
+        self._on = value > 0
+        self._stage('on', self._on)
+        if self._on:
             # brightness cannot be set when light is turned off
-            self._set('bri', value)
+            self._stage('bri', value)
 
     @on.setter
     def on(self, value):
         self._on = value
+        self._stage('on', value)
         if value:
-            self._set('on', True)
-            self.brightness = self._brightness
-        else:
-            self._set('on', False)
+            self._stage('bri', self._brightness)
 
     def print_connection_status_updates(self):
+        """
+        Prints when the light becomes reachable or out of range. Returns True
+        when it has become reachable again. Its state is then unknown, so
+        everything is sent again on the next commit.
+        """
         reachable = self.reachable
         if self._reachable != reachable:
             now = datetime.datetime.now()
             timestamp = now.strftime("%Y-%m-%d %H:%M")
+            came_back = self._reachable is False and reachable
             self._reachable = reachable
-            name = self._bridge.get_light(self.lid, 'name')
+            name = self._get('name')
             print("{}: {} is now {}".format(
                   timestamp, name, "reachable" if reachable else "out of range"))
+            if came_back:
+                self._sent = {}
+                return True
+        return False
+
+    def commit(self):
+        """
+        Sends all changed attributes to the bridge in a single command.
+        """
+        state = self._take_pending()
+        if not state:
+            return
+        # marked before queueing, so that a failure reported meanwhile is kept
+        self._mark_sent(state)
+        if self._command_queue:
+            self._command_queue.put(self.lid, state, self._forget)
+        else:
+            result = self._bridge.set_light(self.lid, state)
+            metrics.bridge_commands.inc(kind='light')
+            self._invalidate()
+            self._forget(failed_attributes(result, state))
+
+    def transition(self, seconds):
+        """
+        Makes the bridge fade to the next committed state over seconds.
+        """
+        self._pending['transitiontime'] = int(round(seconds * 10))
+
+    def _take_pending(self):
+        state, self._pending = self._pending, {}
+        if set(state) <= {'transitiontime'}:
+            # nothing changes, no need to send a transition
+            return {}
+        return state
+
+    def _mark_sent(self, state):
+        # only one of the color spaces is in effect
+        if 'xy' in state:
+            self._sent.pop('ct', None)
+        if 'ct' in state:
+            self._sent.pop('xy', None)
+        self._sent.update((key, value) for key, value in state.items()
+                          if key not in ('alert', 'transitiontime'))
+
+    def _forget(self, keys):
+        """
+        Forgets that attributes were sent and stages them again, so that
+        they are sent again on the next commit.
+        """
+        for key in keys:
+            self._sent.pop(key, None)
+            if key in self._wanted:
+                # unless something newer was staged meanwhile
+                self._pending.setdefault(key, self._wanted[key])
+
+    def _stage(self, key, value):
+        if key == 'xy':
+            self._wanted.pop('ct', None)
+        if key == 'ct':
+            self._wanted.pop('xy', None)
+        self._wanted[key] = value
+        if self._sent.get(key) != value:
+            self._pending[key] = value
+        else:
+            self._pending.pop(key, None)
 
     def _set(self, key, value):
         self._bridge.set_light(self.lid, key, value)
+        metrics.bridge_commands.inc(kind='light')
+        self._invalidate()
 
     def _get(self, key):
+        if self._state_cache:
+            return self._state_cache.get(self.lid, key)
         return self._bridge.get_light(self.lid, key)
+
+    def _invalidate(self):
+        if self._state_cache:
+            self._state_cache.invalidate()
         
     def flash(self):
-        self._set('alert', 'lselect')
+        self._pending['alert'] = 'lselect'
+
+
+class HueLightGroup(Light):
+    """
+    Several hue lights controlled together through a bridge group, so that
+    every change is a single group command instead of one command per light.
+    """
+    supports_effects = True
+
+    def __init__(self, associated_bridge, group_id, lights, command_queue=None):
+        self._bridge = associated_bridge
+        self._command_queue = command_queue
+        self.gid = group_id
+        self.lights = lights
+        self._name = ",".join(light.name for light in lights)
+        self._color = None
+        self._brightness = 0
+        self._on = False
+        self._flash = False
+
+    @property
+    def color(self):
+        return self._color
+
+    @property
+    def brightness(self):
+        return self._brightness
+
+    @property
+    def on(self):
+        return self._on
+
+    @color.setter
+    def color(self, color):
+        self._color = color
+        for light in self.lights:
+            light.color = color
+
+    @brightness.setter
+    def brightness(self, value):
+        self._brightness = value
+        for light in self.lights:
+            light.brightness = value
+        self._on = value > 0
+
+    @on.setter
+    def on(self, value):
+        self._on = value
+        for light in self.lights:
+            light.on = value
+
+    def flash(self):
+        self._flash = True
+
+    def transition(self, seconds):
+        for light in self.lights:
+            light.transition(seconds)
+
+    def commit(self):
+        """
+        Sends the attributes changed on any of the lights as one group command.
+        """
+        state = {}
+        for light in self.lights:
+            state.update(light._take_pending())
+        if self._flash:
+            state['alert'] = 'lselect'
+            self._flash = False
+        if not state:
+            return
+        for light in self.lights:
+            light._mark_sent(state)
+        if self._command_queue:
+            self._command_queue.put_group(self.gid, state, self._forget)
+        else:
+            result = self._bridge.set_group(self.gid, state)
+            metrics.bridge_commands.inc(kind='group')
+            self._forget(failed_attributes(result, state))
+
+    def _forget(self, keys):
+        for light in self.lights:
+            light._forget(keys)
 
 
 class HueLightController(LightController):
-    def __init__(self, ip):
-        self.bridge = self._connect_to_bridge(ip)
+    def __init__(self, ip, command_rate=10, state_ttl=5, bridge=None):
+        self.bridge = bridge or self._connect_to_bridge(ip)
+        self.state_cache = LightStateCache(self.bridge, state_ttl)
+        self.command_queue = BridgeCommandQueue(self.bridge, command_rate,
+                                                on_sent=self.state_cache.invalidate)
         self.lights = self._create_lights(self.bridge)
         
     def _connect_to_bridge(self, ip):
@@ -125,7 +506,24 @@ class HueLightController(LightController):
         return b
 
     def _create_lights(self, bridge):
-        return [HueLight(bridge, key) for key in bridge.get_light_objects('id').keys()]
+        return [HueLight(bridge, int(key), self.command_queue, self.state_cache)
+                for key in self.state_cache.lights().keys()]
+
+    def update_lights(self):
+        """
+        Adds lights that have been added to the bridge since the lights were
+        created. Existing lights are kept.
+        """
+        self.state_cache.invalidate()
+        known = {light.lid for light in self.lights}
+        self.lights += [HueLight(self.bridge, int(key), self.command_queue, self.state_cache)
+                        for key in self.state_cache.lights().keys() if int(key) not in known]
+
+    def flush(self, timeout=None):
+        return self.command_queue.flush(timeout)
+
+    def close(self):
+        self.command_queue.close()
 
     def print_status(self):
         print("{:<6}{:<30}{:<20}".format("Id", "Name", "Reachable"))
@@ -133,12 +531,40 @@ class HueLightController(LightController):
             print("{:<6}{}".format(i, l))
 
     def print_connection_status_updates(self):
+        """
+        Returns the lights that have become reachable again.
+        """
+        reconnected = []
         for l in self.lights:
-            l.print_connection_status_updates()
+            if l.print_connection_status_updates():
+                reconnected.append(l)
+        return reconnected
 
     def light_from_name(self, name):
         return next((l for l in self.lights if l.name==name), None)
 
+    def group_for(self, lights):
+        """
+        Returns a HueLightGroup for the lights, reusing a bridge group with
+        exactly these lights or creating a new one. Returns None if the
+        bridge cannot create the group.
+        """
+        lids = sorted(str(light.lid) for light in lights)
+        groups = self.bridge.get_group() or {}
+        gid = next((gid for gid, group in groups.items()
+                    if sorted(group.get('lights', [])) == lids), None)
+        if gid is None:
+            # bridge group names are at most 32 characters
+            name = (GROUP_NAME_PREFIX + ",".join(light.name for light in lights))[:32]
+            result = self.bridge.create_group(name, [int(lid) for lid in lids])
+            try:
+                gid = result[0]['success']['id']
+            except (IndexError, KeyError, TypeError):
+                print("Failed to create group for {}: {}".format(
+                      ",".join(light.name for light in lights), result))
+                return None
+        return HueLightGroup(self.bridge, gid, lights, self.command_queue)
+
     def remove_light(self, light):
         address = '/api/' + self.bridge.username + '/lights/' + str(light.lid)
         result = self.bridge.request(mode='DELETE', address=address)
@@ -215,3 +641,7 @@ if __name__ == "__main__":
 
         if args.on:
             light.on = True
+
+        light.commit()
+
+    c.flush()
@@ -1,14 +1,68 @@
-import ast
-from re import match
-from urllib import request
+import gzip
+import http.client
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+import time
+import zlib
+from threading import Lock
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urljoin, urlsplit
+from retry import CircuitBreaker, RetryPolicy
+import metrics
+
+# Newest builds to consider, same as the default length of the jenkins builds list
+MAX_BUILDS = 100
+
+# Seconds between refetching the claim of an unchanged failed build
+CLAIM_RECHECK_INTERVAL = 60
+
+# Seconds before the cached jobs of a view are refreshed
+VIEW_TTL = 600
+
+# Projections of the jenkins api data, keeping only the fields that are used.
+# Of the builds only the oldest of the newest MAX_BUILDS is fetched, if there
+# are fewer builds that is the first build.
+_TOP_LEVEL_TREE = 'jobs[name,url,color],views[name,url]'
+_VIEW_TREE = 'jobs[name,url,color]'
+_JOB_TREE = ('name,color,lastFailedBuild[number],lastStableBuild[number],'
+             'lastCompletedBuild[number,url,timestamp],builds[number]{{{},{}}},firstBuild[number]').format(
+             MAX_BUILDS - 1, MAX_BUILDS)
+_BUILD_TREE = 'number,timestamp,actions[claimed]'
+_BULK_TREE = ('jobs[name,url,color,lastFailedBuild[number],lastStableBuild[number],'
+              'lastCompletedBuild[number,timestamp,actions[claimed]],builds[number]{{{},{}}},'
+              'firstBuild[number]]').format(MAX_BUILDS - 1, MAX_BUILDS)
+
+# Returned instead of data by conditional fetches when jenkins answers 304
+NOT_MODIFIED = object()
+
+class FetchError(Exception):
+    pass
+
 
 class Jenkins():
 
-    def __init__(self, url):
+    def __init__(self, url, job_registry=None, view_ttl=VIEW_TTL, max_view_requests=4):
         self._url = url
-        top_data = _fetch_data(url)        
+        self._job_registry = job_registry or JobRegistry()
+        self._view_ttl = view_ttl
+        # view url -> (jobs in the view, time.monotonic() when fetched)
+        self._view_jobs = {}
+        self._view_lock = Lock()
+        self._view_executor = ThreadPoolExecutor(max_workers=max_view_requests)
+        self.jobs = {}
+        self.view_urls = {}
+        # ids of the jobs updated from the current bulk data
+        self._bulk_updated = set()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reads the top level jobs and views. Cached view members are kept.
+        """
+        top_data = _fetch_data(self._url, tree=_TOP_LEVEL_TREE)
         try:
-            self.jobs = { job['name'] : JenkinsJob(job['url']) for job in top_data['jobs'] }
+            self.jobs = { job['name'] : self._job_registry.job(job['url'], job['name'], job.get('color'))
+                          for job in top_data['jobs'] }
             self.view_urls = { view['name'] : view['url'] for view in top_data['views'] }
         except KeyError:
             print("WARNING: Cannot parse top level jobs")
@@ -17,32 +71,162 @@ class Jenkins():
             len(self.jobs), len(self.view_urls), self._url))
 
     def _get_jobs_in_view(self, view_url):
+        view_data = _fetch_data(view_url, tree=_VIEW_TREE)
         try:
-            view_data = _fetch_data(view_url)
-            return [self.jobs['name'] for job in view_data['jobs']]
+            return [self._job_registry.job(job['url'], job.get('name'), job.get('color'))
+                    for job in view_data['jobs']]
         except KeyError:
-            print("ERROR: Missing job on jenkins {} listed in view {}".format(
-                self._url, job_or_view_name))
+            print("ERROR: Cannot parse jobs on jenkins {} listed in view {}".format(
+                self._url, view_url))
         return []
 
-    def get_jobs(self, job_or_view_name):
+    def get_jobs_in_views(self, view_urls):
         """
-        Returns all jobs that match a regular expression on the job name and
-        if a view name is matched; all jobs within that view is also returned.
+        Returns a dict with the jobs in each view. Views that are not cached,
+        or were cached longer than the view ttl ago, are fetched concurrently.
+        A cached view that cannot be refetched keeps its cached jobs.
         """
-        regexp = job_or_view_name + '$'
-        jobs = [job for name, job in self.jobs.items() if match(regexp, name)]
-        matched_view_urls = [url for name, url in self.view_urls.items() if match(regexp, name)]
-        jobs += [self._get_jobs_in_view(url) for url in matched_view_urls]
+        now = time.monotonic()
+        with self._view_lock:
+            cached = { url : self._view_jobs[url] for url in view_urls if url in self._view_jobs }
+        view_jobs = { url : jobs for url, (jobs, fetched) in cached.items() if now - fetched < self._view_ttl }
+        futures = { url : self._view_executor.submit(self._fetch_view, url)
+                    for url in view_urls if url not in view_jobs }
+        # let all requests finish before raising any error
+        wait(futures.values())
+        for url, future in futures.items():
+            try:
+                view_jobs[url] = future.result()
+            except FetchError as err:
+                if url not in cached:
+                    raise
+                print("Failed to refresh view {}, keeping its cached jobs: {}".format(url, err))
+                view_jobs[url] = cached[url][0]
+        return view_jobs
+
+    def _fetch_view(self, view_url):
+        jobs = self._get_jobs_in_view(view_url)
+        with self._view_lock:
+            self._view_jobs[view_url] = (jobs, time.monotonic())
         return jobs
 
+    @property
+    def url(self):
+        return self._url
+
+    def update_jobs(self, jobs, deadline=None):
+        """
+        Updates all given jobs that are top level jobs on this jenkins from a
+        single request. Returns the jobs that were updated.
+
+        The request is conditional once all given top level jobs have been
+        updated from the current data, unchanged data is not parsed again.
+        """
+        top_level = { id(job) for job in self.jobs.values() }
+        conditional = all(id(job) in self._bulk_updated for job in jobs if id(job) in top_level)
+        data = _fetch_data(self._url, tree=_BULK_TREE, conditional=conditional, deadline=deadline)
+        if data is NOT_MODIFIED:
+            updated = [job for job in jobs if id(job) in self._bulk_updated]
+            for job in updated:
+                job.update_unchanged()
+            return updated
+        jobs_data = { job['url'].rstrip('/') : job for job in data.get('jobs', []) }
+        updated = []
+        for job in jobs:
+            job_data = jobs_data.get(job.url.rstrip('/'))
+            if job_data is not None:
+                job.update_from_data(job_data)
+                updated.append(job)
+        self._bulk_updated = { id(job) for job in updated }
+        return updated
+
+    def match_jobs(self, matcher):
+        """
+        Returns a dict with the jobs matched by each key of a JobMatcher,
+        from a single pass over all job and view names. The jobs of a
+        matched view are included.
+        """
+        matched = {}
+        for name, job in self.jobs.items():
+            for key in matcher.match(name):
+                matched.setdefault(key, []).append(job)
+        matched_views = {}
+        for name, url in self.view_urls.items():
+            keys = matcher.match(name)
+            if keys:
+                matched_views[url] = keys
+        view_jobs = self.get_jobs_in_views(list(matched_views))
+        for url, keys in matched_views.items():
+            for key in keys:
+                matched.setdefault(key, []).extend(view_jobs[url])
+        return matched
+
+class JobRegistry():
+    """
+    Keeps a single JenkinsJob per job url. Jobs that are watched by several
+    alerts, or that are reached through several views, are the same object
+    and thus only fetched once per poll cycle.
+    """
+    def __init__(self, claim_recheck_interval=CLAIM_RECHECK_INTERVAL, state_store=None):
+        self._jobs = {}
+        self._lock = Lock()
+        self._claim_recheck_interval = claim_recheck_interval
+        self._state_store = state_store
+
+    def job(self, url, name=None, color=None):
+        """
+        Returns the job of url, created on first use. The name and color from
+        a job listing are kept so that they need not be fetched per job.
+        """
+        key = url.rstrip('/')
+        with self._lock:
+            if key not in self._jobs:
+                job = JenkinsJob(url, name,
+                    claim_recheck_interval=self._claim_recheck_interval)
+                if self._state_store:
+                    state = self._state_store.job_state(url)
+                    if state:
+                        job.state = state
+                self._jobs[key] = job
+            job = self._jobs[key]
+            job.update_listing(name, color)
+            return job
+
+
+def unique_jobs(jobs):
+    """
+    Returns the jobs with duplicates removed, keeping the original order.
+    """
+    return list({id(job) : job for job in jobs}.values())
+
+
 class JenkinsJob():
+    # there can be tens of thousands of jobs, keep them without a __dict__
+    __slots__ = ('_name', 'url', '_ignore_never_successful', '_claim_recheck_interval',
+                 '_claim_checked', '_oldest_build_nr', '_last_build_nr',
+                 '_last_failed_build_nr', '_last_stable_build_nr', '_claimed',
+                 '_unknown', 'color', 'last_build_time', 'version')
 
     def __init__(self, url, name=None,
-                 ignore_never_successful=True):
+                 ignore_never_successful=True,
+                 claim_recheck_interval=CLAIM_RECHECK_INTERVAL):
         self._name = name
         self.url = url
         self._ignore_never_successful = ignore_never_successful
+        self._claim_recheck_interval = claim_recheck_interval
+        self._claim_checked = None
+        self._oldest_build_nr = None
+        self._last_build_nr = None
+        self._last_failed_build_nr = None
+        self._last_stable_build_nr = None
+        self._claimed = False
+        self._unknown = False
+        # ball color of the job as listed by jenkins, e.g. blue, red or red_anime
+        self.color = None
+        # time.time() when the last completed build started, if known
+        self.last_build_time = None
+        # incremented each time the build state changes, 0 until it is known
+        self.version = 0
 
     def __str__(self):
         return self.name
@@ -50,9 +234,18 @@ class JenkinsJob():
     @property
     def name(self):
         if not self._name:
-            data = _fetch_data(self.url)
+            data = _fetch_data(self.url, tree='name')
             self._name = data['name']
         return self._name
+
+    def update_listing(self, name=None, color=None):
+        """
+        Keeps the name and color of the job as seen in a job listing.
+        """
+        if name:
+            self._name = name
+        if color:
+            self.color = color
         
     def ok(self, allow_nr_failed_jobs=0):
         return self.last_ok or (self.nr_times_same_state <= allow_nr_failed_jobs)
@@ -75,9 +268,113 @@ class JenkinsJob():
     @property
     def claimed(self):
         return self._claimed
+
+    @property
+    def building(self):
+        """
+        True when jenkins listed the job with a build in progress.
+        """
+        return bool(self.color) and self.color.endswith('_anime')
+
+    @property
+    def unknown(self):
+        """
+        True when the last update failed. The job then keeps its last known state.
+        """
+        return self._unknown
     
-    def update(self):
-        data = _fetch_data(self.url)
+    def update(self, deadline=None):
+        with metrics.job_update_seconds.time():
+            try:
+                # only data that has been parsed before can be left unchanged
+                data = _fetch_data(self.url, tree=_JOB_TREE, conditional=self._last_build_nr is not None,
+                                   deadline=deadline)
+                if data is NOT_MODIFIED:
+                    build = None
+                    if self._needs_build_details(self._last_build_nr):
+                        build = _fetch_data('{}/{}'.format(self.url.rstrip('/'), self._last_build_nr),
+                                            tree=_BUILD_TREE, deadline=deadline)
+                elif _has_build_data(data) and \
+                   self._needs_build_details(data['lastCompletedBuild']['number']):
+                    data['lastCompletedBuild'] = _fetch_data(data['lastCompletedBuild']['url'],
+                                                             tree=_BUILD_TREE, deadline=deadline)
+            except FetchError as err:
+                metrics.job_updates.inc(outcome='unknown')
+                self.mark_unknown(err)
+                return
+            version = self.version
+            if data is NOT_MODIFIED:
+                self.update_unchanged(build)
+            else:
+                self.update_from_data(data)
+            metrics.job_updates.inc(outcome='changed' if self.version != version else 'unchanged')
+
+    def mark_unknown(self, reason):
+        if not self._unknown:
+            print("Status of {} is unknown, keeping last known state: {}".format(self.url, reason))
+        self._unknown = True
+
+    def _needs_build_details(self, last_build_nr):
+        """
+        The last completed build only has to be fetched when it is a new
+        build, or when the claim of a failed build is due for a recheck.
+        """
+        if last_build_nr != self._last_build_nr or self._claim_checked is None:
+            return True
+        if self.last_ok:
+            return False
+        return time.monotonic() - self._claim_checked >= self._claim_recheck_interval
+
+    def update_from_data(self, data):
+        """
+        Updates the job from job api data. The claim is read from the actions
+        of lastCompletedBuild if they are included, otherwise the claim seen
+        earlier for the same build is kept.
+        """
+        state = self.state
+        self.update_listing(data.get('name'), data.get('color'))
+        self._update_from_data(data)
+        if self.state != state:
+            self.version += 1
+
+    def update_unchanged(self, last_completed_build=None):
+        """
+        Updates the job when jenkins answered that its data did not change.
+        Only the claim can change, if the last completed build was refetched.
+        """
+        state = self.state
+        self._mark_known()
+        if last_completed_build and 'actions' in last_completed_build:
+            self._claimed = _is_claimed(last_completed_build)
+            self._claim_checked = time.monotonic()
+        if self.state != state:
+            self.version += 1
+
+    def _mark_known(self):
+        if self._unknown:
+            print("Status of {} is known again".format(self.url))
+        self._unknown = False
+
+    @property
+    def state(self):
+        """
+        The build state of the job, as a list that can be stored and set back.
+        """
+        return [self._oldest_build_nr, self._last_build_nr, self._last_failed_build_nr,
+                self._last_stable_build_nr, self._claimed]
+
+    @state.setter
+    def state(self, state):
+        (self._oldest_build_nr, self._last_build_nr, self._last_failed_build_nr,
+         self._last_stable_build_nr, self._claimed) = state
+        # the claim is as old as the stored state, recheck it in due time
+        self._claim_checked = time.monotonic()
+        self.version += 1
+
+    def _update_from_data(self, data):
+        previous_build_nr = self._last_build_nr
+        previous_claimed = self._claimed
+        self._mark_known()
 
         self._oldest_build_nr = None
         self._last_build_nr = None
@@ -85,17 +382,23 @@ class JenkinsJob():
         self._last_stable_build_nr = None
         self._claimed = False
         
-        if 'builds' not in data or not data['builds'] or \
-           'lastFailedBuild' not in data or \
-           'lastStableBuild' not in data or \
-           'lastCompletedBuild' not in data:
+        if not _has_build_data(data):
             print("Missing data in jenkins job api")
             return
 
-        self._oldest_build_nr = min([int(build['number']) for build in data['builds']])
-        last_completed_build = _fetch_data(data['lastCompletedBuild']['url'])
-        self._claimed = any([action.get('claimed', False) for action in last_completed_build['actions']])
+        if data.get('builds'):
+            self._oldest_build_nr = min(int(build['number']) for build in data['builds'])
+        else:
+            self._oldest_build_nr = int(data['firstBuild']['number'])
+        last_completed_build = data['lastCompletedBuild']
         self._last_build_nr = last_completed_build['number']
+        if last_completed_build.get('timestamp'):
+            self.last_build_time = last_completed_build['timestamp'] / 1000
+        if 'actions' in last_completed_build:
+            self._claimed = _is_claimed(last_completed_build)
+            self._claim_checked = time.monotonic()
+        elif self._last_build_nr == previous_build_nr:
+            self._claimed = previous_claimed
 
         if data['lastFailedBuild']:
             self._last_failed_build_nr = data['lastFailedBuild'].get('number', None)
@@ -110,18 +413,212 @@ class JenkinsJob():
                 print('Failed {}'.format(self.url))
 
 
-def _fetch_data(url, tries=10):
+class HttpPool():
+    """
+    HTTP client keeping persistent keep-alive connections to each host.
+    At most pool_size idle connections per host are kept for reuse.
+
+    Conditional requests remember the ETag / Last-Modified of the response
+    and return NOT_MODIFIED when the server answers 304 Not Modified.
+    """
+    MAX_REDIRECTS = 5
+    # how a request fails on a kept-alive connection the server has closed
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+    def __init__(self, pool_size=4, timeout=10):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle = {}
+        self._validated = {}
+        self._lock = Lock()
+
+    def get(self, url, conditional=False, timeout=None, redirects=0):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = {'Accept-Encoding' : 'gzip'}
+        validated = self._validated.get(url) if conditional else None
+        if validated:
+            etag, last_modified = validated
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        timeout = self.timeout if timeout is None else timeout
+        conn, reused = self._acquire(key, timeout)
+        try:
+            response = self._request(conn, path, headers)
+        except self.STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            # the server has closed the idle connection, retry on a new one.
+            # Anything else, like a timeout, is left to the retry policy.
+            conn, _ = self._acquire(key, timeout, reuse=False)
+            try:
+                response = self._request(conn, path, headers)
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+        try:
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location and \
+           redirects < self.MAX_REDIRECTS:
+            return self.get(urljoin(url, location), conditional, timeout, redirects + 1)
+        if response.status == 304 and validated:
+            return NOT_MODIFIED
+        if response.status != 200:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        if conditional:
+            with self._lock:
+                if etag or last_modified:
+                    self._validated[url] = (etag, last_modified)
+                else:
+                    self._validated.pop(url, None)
+        return body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def _request(self, conn, path, headers):
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+
+    def _acquire(self, key, timeout, reuse=True):
+        with self._lock:
+            connections = self._idle.get(key)
+            conn = connections.pop() if reuse and connections else None
+        if conn:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.pool_size:
+                connections.append(conn)
+                return
+        conn.close()
+
+
+# Connection pool shared by all jenkins requests
+http_pool = HttpPool()
+
+retry_policy = RetryPolicy()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = Lock()
+
+def _circuit_breaker(url):
+    host = urlsplit(url).netloc
+    with _circuit_breakers_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker()
+        return _circuit_breakers[host]
+
+
+def _has_build_data(data):
+    return (data.get('builds') or data.get('firstBuild')) and \
+        'lastFailedBuild' in data and \
+        'lastStableBuild' in data and \
+        data.get('lastCompletedBuild')
+
+
+def _is_claimed(build):
+    return any(action.get('claimed', False) for action in build['actions'])
+
+
+def _fetch_data(url, tree=None, conditional=False, deadline=None):
+    """
+    Fetches jenkins api data, retrying with backoff until it succeeds, the
+    retries are used up or the deadline (a time.monotonic() value) is passed.
+    Conditional fetches return NOT_MODIFIED when the data did not change
+    since it was last fetched. Raises FetchError on failure.
+    """
+    api_url = url + "/api/json"
+    if tree:
+        api_url += "?" + urlencode({'tree' : tree})
+    host = urlsplit(url).netloc
+    breaker = _circuit_breaker(url)
+    tries = retry_policy.tries
     for i in range(1, tries+1):
+        timeout = http_pool.timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise FetchError("poll cycle deadline passed")
+        if not breaker.allow():
+            metrics.fetch_refused.inc(host=host)
+            raise FetchError("{} is not responding".format(host))
+        if i > 1:
+            metrics.fetch_retries.inc(host=host)
+        outcome = None
         try:
-            x = request.urlopen(url + "/api/python", timeout=10)
-            y = x.read().decode("utf-8")
-            break
-        except:
-            print("Failed to fetch {} (try {}/{})".format(url, i, tries))
-            if i >= tries:
-                exit(1)
-    return ast.literal_eval(y)
+            with metrics.fetch_seconds.time(host=host):
+                y = http_pool.get(api_url, conditional, timeout)
+            outcome = 'ok'
+        except HTTPError as err:
+            # on 4xx the server is fine, retrying will not help
+            outcome = 'client_error' if 400 <= err.code < 500 else 'error'
+            error = err
+        except (http.client.HTTPException, OSError, EOFError, zlib.error) as err:
+            outcome = 'error'
+            error = err
+        finally:
+            # always settle the breaker, a half-open trial must not be left running
+            if outcome in ('ok', 'client_error'):
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        metrics.fetch_requests.inc(host=host, outcome=outcome)
+        if outcome == 'client_error':
+            raise FetchError(error)
+        if outcome == 'ok':
+            if y is NOT_MODIFIED:
+                return y
+            try:
+                return json.loads(y)
+            except ValueError as err:
+                raise FetchError("invalid json: {}".format(err))
 
+        print("Failed to fetch {} (try {}/{}): {}".format(url, i, tries, error))
+        delay = retry_policy.delay(i)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            break
+        if i < tries:
+            time.sleep(delay)
+    raise FetchError("failed to fetch {}".format(url))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -0,0 +1,52 @@
+import re
+
+# References to groups, e.g. \1, (?P=name) or (?(1)...). Groups are numbered
+# differently once the patterns are combined, so the references would point
+# at the wrong groups.
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+class JobMatcher():
+    """
+    Resolves job and view names to the alerts watching them.
+
+    Each alert, identified by a key, has regular expressions that must match
+    the whole name, and substrings of job names to ignore. All expressions
+    are compiled once, and a combined expression rejects names that no
+    alert watches with a single match.
+    """
+    def __init__(self):
+        self._patterns = []
+        self._ignores = {}
+        self._any = None
+
+    def add(self, key, patterns, ignores=()):
+        for pattern in patterns:
+            self._patterns.append((re.compile(pattern + '$'), key))
+        if ignores:
+            self._ignores[key] = re.compile('|'.join(re.escape(ignored) for ignored in ignores))
+        self._any = None
+
+    def match(self, name):
+        """
+        Returns the keys of the alerts watching name.
+        """
+        if self._any is None:
+            self._any = self._combine()
+        if self._any is not False and not self._any.match(name):
+            return set()
+        return {key for regexp, key in self._patterns if regexp.match(name)}
+
+    def is_ignored(self, key, job_name):
+        ignores = self._ignores.get(key)
+        return bool(ignores and ignores.search(job_name))
+
+    def _combine(self):
+        if not self._patterns:
+            return re.compile('(?!)')
+        if any(_GROUP_REFERENCE.search(regexp.pattern) for regexp, _ in self._patterns):
+            return False
+        try:
+            return re.compile('|'.join('(?:{})'.format(regexp.pattern) for regexp, _ in self._patterns))
+        except re.error:
+            # e.g. the same group name in several patterns
+            return False
@@ -1,4 +1,7 @@
 class Light():
+    # whether the EffectEngine animates the light, a virtual light has no lamp to animate
+    supports_effects = False
+
     def __init__(self, name, enable_debug_print=False):
         self._name = name
         self._color = None
@@ -46,6 +49,18 @@ class Light():
     def flash(self):
         self._print("flashing")
 
+    def transition(self, seconds):
+        """
+        Fades to the next committed state over seconds, where supported.
+        """
+        pass
+
+    def commit(self):
+        """
+        Sends the changed state to the lamp. Nothing to send for a virtual light.
+        """
+        pass
+
     def _print(self, text):
         if self._debug_prints:
             print("Light '{name}': {text}".format(
@@ -0,0 +1,194 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class _Metric():
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} {}".format(self.name, self.type_name)]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key, value):
+        return ["{}{} {}".format(self.name, _labels(key), _number(value))]
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ((0,) * len(self._buckets), 0.0, 0))
+            counts = tuple(n + (value <= bound) for n, bound in zip(counts, self._buckets))
+            self._values[key] = (counts, total + value, count + 1)
+        return value
+
+    def time(self, **labels):
+        """
+        Context manager observing the time spent in its block.
+        """
+        return _Timer(self, labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = ["{}_bucket{} {}".format(self.name, _labels(key + (('le', _number(bound)),)), n)
+                 for bound, n in zip(self._buckets, counts)]
+        lines.append("{}_bucket{} {}".format(self.name, _labels(key + (('le', '+Inf'),)), count))
+        lines.append("{}_sum{} {}".format(self.name, _labels(key), _number(total)))
+        lines.append("{}_count{} {}".format(self.name, _labels(key), count))
+        return lines
+
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = self._histogram.observe(time.monotonic() - self._start, **self._labels)
+        return False
+
+
+class Registry():
+    def __init__(self):
+        self._metrics = []
+        self._lock = Lock()
+
+    def counter(self, name, help_text):
+        return self._add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, buckets))
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+class MetricsServer():
+    """
+    Serves the metrics of a registry on http://<host>:<port>/metrics. Only
+    on the loopback interface unless another host address is given.
+    """
+    def __init__(self, port, metrics_registry=None, host='127.0.0.1'):
+        self._registry = metrics_registry or registry
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        print("Serving metrics on {}:{}".format(self._server.server_address[0], self.port))
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        metrics_registry = self._registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics_registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in key) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Registry used by all of team-alert
+registry = Registry()
+
+fetch_seconds = registry.histogram('teamalert_jenkins_request_seconds', 'Duration of jenkins api requests per host')
+fetch_requests = registry.counter('teamalert_jenkins_requests_total', 'Jenkins api requests per host and outcome')
+fetch_retries = registry.counter('teamalert_jenkins_retries_total', 'Retried jenkins api requests per host')
+fetch_refused = registry.counter('teamalert_jenkins_circuit_open_total', 'Jenkins api requests refused by an open circuit breaker per host')
+job_update_seconds = registry.histogram('teamalert_job_update_seconds', 'Duration of updating a single jenkins job')
+job_updates = registry.counter('teamalert_job_updates_total', 'Job updates per outcome')
+alert_evaluate_seconds = registry.histogram('teamalert_alert_evaluate_seconds', 'Duration of evaluating an alert',
+                                            (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+bridge_commands = registry.counter('teamalert_bridge_commands_total', 'Commands sent to the hue bridge per kind')
+bridge_errors = registry.counter('teamalert_bridge_errors_total', 'Failed hue bridge commands')
+restart_seconds = registry.histogram('teamalert_restart_seconds', 'Duration of config reloads that reloaded something')
+cycle_seconds = registry.histogram('teamalert_poll_cycle_seconds', 'Duration of poll cycles')
+cycle_overruns = registry.counter('teamalert_poll_cycle_overruns_total', 'Poll cycles that took longer than the poll rate')
@@ -0,0 +1,109 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib import request
+import argparse
+import json
+
+class NotificationListener():
+    """
+    Local HTTP server accepting build notifications from jenkins, as sent by
+    the Notification plugin (JSON format). on_notification is called with
+    the decoded notification for each one received.
+    """
+    def __init__(self, port, on_notification, host=''):
+        self._on_notification = on_notification
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        print("Listening for jenkins notifications on port {}".format(self.port))
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    notification = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self.send_error(400, "Invalid json")
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                try:
+                    listener._on_notification(notification)
+                except Exception as err:
+                    # a bad notification must not stop the listener
+                    print("ERROR: Failed to handle notification {}: {}".format(notification, err))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def job_url_of(notification):
+    """
+    Returns the absolute job url of a notification, or None if the
+    notification only holds a relative url.
+    """
+    build = notification.get('build', {})
+    full_url = build.get('full_url')
+    number = build.get('number')
+    if not full_url or number is None:
+        return None
+    suffix = '/{}/'.format(number)
+    full_url = full_url.rstrip('/') + '/'
+    if full_url.endswith(suffix):
+        return full_url[:-len(suffix) + 1]
+    return None
+
+
+def send_notification(listener_url, job_url, number=1, phase='COMPLETED', status='SUCCESS'):
+    """
+    Posts a notification like the one sent by the jenkins Notification plugin.
+    """
+    job_url = job_url.rstrip('/') + '/'
+    name = job_url.rstrip('/').rsplit('/', 1)[-1]
+    notification = {
+        'name' : name,
+        'url' : 'job/{}/'.format(name),
+        'build' : {
+            'full_url' : '{}{}/'.format(job_url, number),
+            'number' : number,
+            'phase' : phase,
+            'status' : status,
+            'url' : 'job/{}/{}/'.format(name, number),
+        }
+    }
+    data = json.dumps(notification).encode('utf-8')
+    req = request.Request(listener_url, data=data, headers={'Content-Type' : 'application/json'})
+    request.urlopen(req, timeout=10).read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listen", type=int, help="print notifications received on this port")
+    parser.add_argument("--send", type=str, help="url of a listener to send a test notification to")
+    parser.add_argument("--job", type=str, help="url of the job in the test notification")
+    parser.add_argument("--number", default=1, type=int, help="build number in the test notification")
+    parser.add_argument("--status", default='SUCCESS', help="build status in the test notification")
+    args = parser.parse_args()
+
+    if args.send:
+        if not args.job:
+            parser.error("missing argument: --job")
+        send_notification(args.send, args.job, args.number, status=args.status)
+
+    if args.listen:
+        listener = NotificationListener(args.listen, print)
+        listener._thread.join()
@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import math
+import time
+from threading import Condition
+from urllib.parse import urlsplit
+
+# Poll interval per second a job has been idle, a job idle for an hour is
+# polled every 6 minutes (within the fast and slow intervals)
+IDLE_FACTOR = 0.1
+
+class PollUnit():
+    """
+    Something that is polled as a whole: a single job, or a jenkins whose
+    watched top level jobs are fetched with one bulk request.
+    """
+    def __init__(self, target, jobs):
+        self.target = target
+        self.jobs = jobs
+
+
+class PollScheduler():
+    """
+    Decides when each unit is polled next. Units with a job that is building
+    or has changed recently are polled every fast_interval seconds, idle ones
+    less often the longer they have been idle, up to slow_interval. Each
+    deadline follows on from the previous one so that polls do not drift,
+    and at most max_requests_per_second units are polled per second on each
+    jenkins host.
+    """
+    def __init__(self, fast_interval=10, slow_interval=600, max_requests_per_second=None):
+        self._fast_interval = fast_interval
+        self._slow_interval = max(slow_interval, fast_interval)
+        self._rate = max_requests_per_second
+        self._units = {}
+        # deadline each unit is scheduled for, by id of its target
+        self._deadlines = {}
+        # (time to poll, sequence number, id of target), outdated entries
+        # are skipped by their sequence number
+        self._heap = []
+        self._entries = {}
+        # ids of targets to poll again as soon as they have been polled
+        self._repoll = set()
+        self._seq = itertools.count()
+        # (version, time.monotonic() of the last change) by id of job
+        self._changed = {}
+        # (requests left, time.monotonic() when counted) by host
+        self._budgets = {}
+        self._cond = Condition()
+
+    def schedule(self, units):
+        """
+        Sets the units to poll. New units are due right away, units that
+        were already scheduled keep their deadline.
+        """
+        now = time.monotonic()
+        with self._cond:
+            units = { id(unit.target) : unit for unit in units }
+            for key in list(self._units):
+                if key not in units:
+                    del self._units[key]
+                    del self._deadlines[key]
+                    self._entries.pop(key, None)
+                    self._repoll.discard(key)
+            for key, unit in units.items():
+                if key not in self._units:
+                    self._push(key, now, now)
+                self._units[key] = unit
+            self._cond.notify_all()
+
+    def poll_now(self, job):
+        """
+        Makes the units with job due right away, e.g. when jenkins notified
+        about a new build. A unit that is being polled is polled again.
+        Their deadlines stay as they were.
+        """
+        now = time.monotonic()
+        with self._cond:
+            for key, unit in self._units.items():
+                if not any(unit_job is job for unit_job in unit.jobs):
+                    continue
+                if key in self._entries:
+                    self._push(key, self._deadlines[key], now)
+                else:
+                    self._repoll.add(key)
+            self._cond.notify_all()
+
+    def due(self):
+        """
+        Returns the units whose deadline has passed, as far as the request
+        budget of their host allows. The others are postponed until there is
+        budget again. Each returned unit must be handed back to polled().
+        """
+        now = time.monotonic()
+        units = []
+        postponed = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, key = heapq.heappop(self._heap)
+                if self._entries.get(key) != seq:
+                    continue
+                unit = self._units[key]
+                wait = self._take_budget(unit, now)
+                if wait:
+                    postponed.append((key, now + wait))
+                else:
+                    del self._entries[key]
+                    units.append(unit)
+            for key, when in postponed:
+                self._push(key, self._deadlines[key], when)
+        return units
+
+    def polled(self, units):
+        """
+        Schedules the next poll of units returned by due(), from how long
+        their jobs have been idle.
+        """
+        now = time.monotonic()
+        with self._cond:
+            for unit in units:
+                key = id(unit.target)
+                if key not in self._units or key in self._entries:
+                    # no longer scheduled, or rescheduled meanwhile
+                    continue
+                # schedule() may have replaced the unit while it was polled
+                unit = self._units[key]
+                interval = self._interval(unit.jobs, now)
+                deadline = self._deadlines[key] + interval
+                if deadline <= now:
+                    # skip the deadlines that were missed instead of catching up
+                    deadline += interval * (math.floor((now - deadline) / interval) + 1)
+                if key in self._repoll:
+                    self._repoll.discard(key)
+                    self._push(key, deadline, now)
+                else:
+                    self._push(key, deadline, deadline)
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a unit is due, the units change or timeout seconds
+        have passed.
+        """
+        with self._cond:
+            if self._heap:
+                delay = self._heap[0][0] - time.monotonic()
+                timeout = delay if timeout is None else min(timeout, delay)
+            if timeout is None or timeout > 0:
+                self._cond.wait(timeout)
+
+    def _interval(self, jobs, now):
+        return min((self._job_interval(job, now) for job in jobs), default=self._slow_interval)
+
+    def _job_interval(self, job, now):
+        if job.building or job.unknown:
+            return self._fast_interval
+        version, changed = self._changed.get(id(job), (None, None))
+        if version is None:
+            # first poll, count from the last build if it is known
+            changed = now
+            if job.last_build_time:
+                changed -= max(0, time.time() - job.last_build_time)
+        elif version != job.version:
+            changed = now
+        self._changed[id(job)] = (job.version, changed)
+        return min(self._slow_interval, max(self._fast_interval, (now - changed) * IDLE_FACTOR))
+
+    def _take_budget(self, unit, now):
+        """
+        Takes one request from the budget of the host of unit. Returns 0 if
+        there was budget left, otherwise the seconds until there is.
+        """
+        if not self._rate:
+            return 0
+        host = urlsplit(unit.target.url).netloc
+        burst = max(1, self._rate)
+        left, counted = self._budgets.get(host, (burst, now))
+        left = min(burst, left + (now - counted) * self._rate)
+        if left < 1:
+            self._budgets[host] = (left, now)
+            return (1 - left) / self._rate
+        self._budgets[host] = (left - 1, now)
+        return 0
+
+    def _push(self, key, deadline, when):
+        seq = next(self._seq)
+        self._deadlines[key] = deadline
+        self._entries[key] = seq
+        heapq.heappush(self._heap, (when, seq, key))
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlsplit
+from jenkins_source import FetchError
+
+class JobPoller():
+    """
+    Refreshes jenkins jobs concurrently. The number of simultaneous requests
+    towards each jenkins host is limited by max_requests_per_host.
+    """
+    def __init__(self, max_requests_per_host=4, max_workers=32):
+        self._max_requests_per_host = max_requests_per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._host_limits = {}
+        self._lock = Lock()
+
+    def update(self, jobs, bulk_sources=(), deadline=None):
+        """
+        Updates all jobs. Jobs that can be updated in bulk from one of the
+        bulk_sources (jenkins instances) are, the rest are fetched one by one.
+        Nothing is fetched after the deadline (a time.monotonic() value).
+        """
+        bulk_updated = set()
+        for updated in self._run(self._update_bulk, [(source, jobs, deadline) for source in bulk_sources]):
+            bulk_updated.update(id(job) for job in updated)
+        remaining = [job for job in jobs if id(job) not in bulk_updated]
+        self._run(self._update_job, [(job, deadline) for job in remaining])
+
+    def _run(self, func, args_list):
+        futures = [self._executor.submit(func, *args) for args in args_list]
+        wait(futures)
+        # re-raise anything that went wrong in a worker thread
+        return [future.result() for future in futures]
+
+    def _update_bulk(self, source, jobs, deadline):
+        with self._host_limit(source.url):
+            try:
+                return source.update_jobs(jobs, deadline)
+            except FetchError as err:
+                # the jobs are tried one by one instead
+                print("Bulk update from {} failed: {}".format(source.url, err))
+                return []
+
+    def _update_job(self, job, deadline):
+        with self._host_limit(job.url):
+            job.update(deadline)
+
+    def _host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = BoundedSemaphore(self._max_requests_per_host)
+            return self._host_limits[host]
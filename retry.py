@@ -0,0 +1,58 @@
+import random
+import time
+from threading import Lock
+
+class RetryPolicy():
+    """
+    Exponential backoff with full jitter: the delay before retry n is a
+    random time between 0 and base_delay * 2^n, capped at max_delay.
+    """
+    def __init__(self, tries=3, base_delay=0.5, max_delay=8):
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker():
+    """
+    Opens after failure_threshold consecutive failures, after which requests
+    are refused without being tried. When reset_timeout has passed a single
+    trial request is let through, closing the circuit again if it succeeds.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened = None
+        self._trial_running = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial_running or \
+               time.monotonic() - self._opened < self._reset_timeout:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self._failure_threshold:
+                self._opened = time.monotonic()
+            self._trial_running = False
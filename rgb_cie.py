@@ -8,17 +8,45 @@ Copyright (c) 2014 Benjamin Knight / MIT License.
 import math
 import random
 from collections import namedtuple
+from functools import lru_cache
 
 
 # Represents a CIE 1931 XY coordinate pair.
 XYPoint = namedtuple('XYPoint', ['x', 'y'])
 
+# Color gamuts (red, green and blue corners) of the Hue lamp models.
+GAMUTS = {
+    'A': (XYPoint(0.704, 0.296), XYPoint(0.2151, 0.7106), XYPoint(0.138, 0.08)),
+    'B': (XYPoint(0.675, 0.322), XYPoint(0.4091, 0.518), XYPoint(0.167, 0.04)),
+    'C': (XYPoint(0.692, 0.308), XYPoint(0.17, 0.7), XYPoint(0.153, 0.048)),
+}
+
+DEFAULT_GAMUT = 'B'
+
+MODEL_GAMUTS = {
+    'LLC001': 'A', 'LLC005': 'A', 'LLC006': 'A', 'LLC007': 'A', 'LLC010': 'A',
+    'LLC011': 'A', 'LLC012': 'A', 'LLC013': 'A', 'LLC014': 'A', 'LST001': 'A',
+    'LCT001': 'B', 'LCT002': 'B', 'LCT003': 'B', 'LCT007': 'B', 'LLM001': 'B',
+    'LCT010': 'C', 'LCT011': 'C', 'LCT012': 'C', 'LCT014': 'C', 'LCT015': 'C',
+    'LCT016': 'C', 'LLC020': 'C', 'LST002': 'C',
+}
+
+
+def gamut_for_model(model_id):
+    """Returns the gamut ('A', 'B' or 'C') of a Hue lamp model, the default gamut if unknown."""
+    return MODEL_GAMUTS.get(model_id, DEFAULT_GAMUT)
+
 
 class ColorHelper:
 
-    Red = XYPoint(0.675, 0.322)
-    Lime = XYPoint(0.4091, 0.518)
-    Blue = XYPoint(0.167, 0.04)
+    Red, Lime, Blue = GAMUTS[DEFAULT_GAMUT]
+
+    def __init__(self, gamut=DEFAULT_GAMUT):
+        self.Red, self.Lime, self.Blue = GAMUTS[gamut]
+        # constant parts of checkPointInLampsReach
+        self._v1 = XYPoint(self.Lime.x - self.Red.x, self.Lime.y - self.Red.y)
+        self._v2 = XYPoint(self.Blue.x - self.Red.x, self.Blue.y - self.Red.y)
+        self._v1_cross_v2 = self.crossProduct(self._v1, self._v2)
 
     def hexToRed(self, hex):
         """Parses a valid hex color string and returns the Red RGB integer value."""
@@ -37,6 +65,10 @@ class ColorHelper:
         rgb = [self.hexToRed(h), self.hexToGreen(h), self.hexToBlue(h)]
         return rgb
 
+    def hexToUnitRGB(self, h):
+        """Converts a valid hex color string to an RGB array of values from 0 to 1."""
+        return [value / 255 for value in self.hexToRGB(h)]
+
     def rgbToHex(self, r, g, b):
         """Converts RGB to hex."""
         return '%02x%02x%02x' % (r, g, b)
@@ -51,12 +83,9 @@ class ColorHelper:
 
     def checkPointInLampsReach(self, p):
         """Check if the provided XYPoint can be recreated by a Hue lamp."""
-        v1 = XYPoint(self.Lime.x - self.Red.x, self.Lime.y - self.Red.y)
-        v2 = XYPoint(self.Blue.x - self.Red.x, self.Blue.y - self.Red.y)
-
         q = XYPoint(p.x - self.Red.x, p.y - self.Red.y)
-        s = self.crossProduct(q, v2) / self.crossProduct(v1, v2)
-        t = self.crossProduct(v1, q) / self.crossProduct(v1, v2)
+        s = self.crossProduct(q, self._v2) / self._v1_cross_v2
+        t = self.crossProduct(self._v1, q) / self._v1_cross_v2
 
         return (s >= 0.0) and (t >= 0.0) and (s + t <= 1.0)
 
@@ -179,24 +208,45 @@ class ColorHelper:
         return (r, g, b)
 
 
+_color_helpers = {gamut: ColorHelper(gamut) for gamut in GAMUTS}
+
+
+@lru_cache(maxsize=1024)
+def _xy_from_rgb(red, green, blue, gamut):
+    return _color_helpers[gamut].getXYPointFromRGB(red, green, blue)
+
+
 class Converter:
 
-    color = ColorHelper()
+    color = _color_helpers[DEFAULT_GAMUT]
+
+    def __init__(self, gamut=DEFAULT_GAMUT):
+        self.gamut = gamut
+        self.color = _color_helpers[gamut]
 
     def hexToCIE1931(self, h):
         """Converts hexadecimal colors represented as a String to approximate CIE 1931 coordinates.
         May not produce accurate values."""
-        rgb = self.color.hexToRGB(h)
+        rgb = self.color.hexToUnitRGB(h)
         return self.rgbToCIE1931(rgb[0], rgb[1], rgb[2])
 
     def rgbToCIE1931(self, red, green, blue):
-        """Converts red, green and blue integer values to approximate CIE 1931 x and y coordinates.
+        """Converts red, green and blue values from 0 to 1 to approximate CIE 1931 x and y coordinates.
         Algorithm from: http://www.easyrgb.com/index.php?X=MATH&H=02#text2.
         May not produce accurate values.
         """
-        point = self.color.getXYPointFromRGB(red, green, blue)
+        point = _xy_from_rgb(red, green, blue, self.gamut)
         return [point.x, point.y]
 
+    def rgbListToCIE1931(self, rgb_list):
+        """Converts a list of (red, green, blue) values to a list of [x, y] coordinates.
+        Conversions are memoized per gamut, so repeated colors cost a lookup."""
+        return [self.rgbToCIE1931(red, green, blue) for red, green, blue in rgb_list]
+
+    def hexListToCIE1931(self, hex_list):
+        """Converts a list of hexadecimal color strings to a list of [x, y] coordinates."""
+        return self.rgbListToCIE1931([self.color.hexToUnitRGB(h) for h in hex_list])
+
     def getCIEColor(self, hexColor=None):
         """Returns the approximate CIE 1931 x, y coordinates represented by the supplied hexColor parameter,
         or of a random color if the parameter is not passed.
@@ -211,7 +261,7 @@ class Converter:
             r = self.color.randomRGBValue()
             g = self.color.randomRGBValue()
             b = self.color.randomRGBValue()
-            xy = self.rgbToCIE1931(r, g, b)
+            xy = self.rgbToCIE1931(r / 255, g / 255, b / 255)
 
         return xy
 
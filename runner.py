@@ -1,34 +1,367 @@
-from jenkins_source import Jenkins
-from alert import Alert
-from hue_light import HueLightController
+from jenkins_source import Jenkins, FetchError, JobRegistry, unique_jobs, http_pool, CLAIM_RECHECK_INTERVAL
+from alert import Alert, make_palette
+from effects import EffectEngine
+from hue_light import HueLight, HueLightController, HueLightGroup
 from light import Light
+from poller import JobPoller
+from poll_scheduler import PollScheduler, PollUnit
+from state_store import StateStore
+from job_matcher import JobMatcher
+from notification_listener import NotificationListener, job_url_of
+from metrics import MetricsServer
+import metrics
+from threading import Lock, RLock, Thread
+import hashlib
 import json
-from os import path, getcwd
+import time
+from os import path, getcwd, stat
 from jsonschema import validate, ValidationError
 import syslog
 
 class Runner():
     def __init__(self, cfg, hue_bridge, jenkins,
-                 create_missing_lights=False):
+                 create_missing_lights=False, max_requests_per_host=4,
+                 bulk_fetch=False, claim_poll_rate=CLAIM_RECHECK_INTERVAL,
+                 cycle_timeout=None, notification_port=None, state_file=None,
+                 metrics_port=None, poll_interval=10, max_poll_interval=600,
+                 max_requests_per_second=None, hue_controller=None, metrics_host='127.0.0.1'):
         self._hue_bridge_ip = hue_bridge
         self._jenkins_ips = jenkins
         self._cfg_path = cfg
         self._create_missing_lights = create_missing_lights
+        self._bulk_fetch = bulk_fetch
+        self._cycle_timeout = cycle_timeout
+        self.alerts = []
+        self._alert_cfgs = []
+        self._cfg_version = None
+        self._hue_controller = hue_controller
+        self._virtual_lights = {}
+        self._jenkinses = []
+        self._alerts_by_job = {}
+        self._alert_keys = {}
+        self._job_versions = {}
+        # ids of the jobs whose state has been fetched at least once
+        self._polled_jobs = set()
+        self._scheduler = PollScheduler(poll_interval, max_poll_interval, max_requests_per_second)
+        # held while alerts are evaluated or replaced
+        self._lock = RLock()
+        # held while a new configuration is built
+        self._reload_lock = Lock()
+        self._effects = EffectEngine(lock=self._lock)
+        self._palette = make_palette()
+        self._poller = JobPoller(max_requests_per_host)
+        # keep one connection per possible simultaneous request
+        http_pool.pool_size = max_requests_per_host
+        self._state_store = StateStore(state_file) if state_file else None
+        self._job_registry = JobRegistry(claim_poll_rate, self._state_store)
+        self._metrics_server = None
+        if metrics_port is not None:
+            self._metrics_server = MetricsServer(metrics_port, host=metrics_host)
         self.restart()
+        self._listener = None
+        if notification_port is not None:
+            self._listener = NotificationListener(notification_port, self.on_notification)
         print("Initialisation done")
 
     def restart(self):
+        """
+        Reloads the config file and rematches the jobs of all alerts, so that
+        jobs added to jenkins or to a view are picked up. Only alerts with a
+        changed config or changed jobs are recreated, lights and jobs are kept
+        with their state. The first load is done right away. Later reloads
+        are built in a background thread while the current alerts keep being
+        updated, and are swapped in when done.
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            # still building the previous reload
+            return
+        cfg_version = self._config_version()
+        if not self.alerts:
+            try:
+                self._reload(cfg_version)
+            finally:
+                self._reload_lock.release()
+        else:
+            Thread(target=self._reload_in_background, args=(cfg_version,), daemon=True).start()
+
+    def _reload_in_background(self, cfg_version):
+        try:
+            self._reload(cfg_version)
+        finally:
+            self._reload_lock.release()
+
+    def _reload(self, cfg_version):
         syslog.syslog('soft restart...')
-        self._load_config(self._cfg_path)
-        hue_controller = HueLightController(self._hue_bridge_ip)
-        virtual_lights = [Light(**args) for args in self.cfg['virtual_lights']]
-        lights = hue_controller.lights + virtual_lights
-        jenkinses = [Jenkins(ip) for ip in self._jenkins_ips]
-        self.alerts = [self.create_alert(cfg, lights, jenkinses, self._create_missing_lights) for cfg in self.cfg['alerts']]
+        try:
+            with metrics.restart_seconds.time():
+                alert_set = self._build_alerts(cfg_version)
+            with self._lock:
+                self._swap_alerts(*alert_set)
+        except (FetchError, OSError, ValueError, ValidationError) as err:
+            print("Failed to reload: {}".format(err))
+            if not self.alerts:
+                exit(1)
+            print("Keeping the previous configuration")
+        else:
+            self._cfg_version = cfg_version
 
-    def update_alerts(self):
+    def _config_version(self):
+        try:
+            mtime = stat(self._cfg_path).st_mtime_ns
+            if self._cfg_version and self._cfg_version[0] == mtime:
+                return self._cfg_version
+            with open(self._cfg_path, 'rb') as cfg_file:
+                digest = hashlib.sha1(cfg_file.read()).hexdigest()
+        except OSError:
+            return None
+        if self._cfg_version and self._cfg_version[1] == digest:
+            # touched but not changed
+            self._cfg_version = (mtime, digest)
+        return (mtime, digest)
+
+    def _build_alerts(self, cfg_version):
+        """
+        Builds the alerts of the config file next to the current ones, reusing
+        the current alerts whose config and matched jobs have not changed.
+        """
+        if self.alerts and cfg_version == self._cfg_version:
+            # the config file is unchanged, only the jobs may have changed
+            config = self.cfg
+        else:
+            config = self._load_config(self._cfg_path)
+        if not self._hue_controller:
+            self._hue_controller = HueLightController(self._hue_bridge_ip)
+        lights, virtual_lights = self._lights(config)
+        jenkinses = self._refresh_jenkinses()
+        matched_jobs = self._match_alert_jobs(config['alerts'], jenkinses)
+
+        previous_alerts = {}
+        for key, alert in self._alert_cfgs:
+            previous_alerts.setdefault(key, []).append(alert)
+        alert_cfgs = []
+        new_cfgs = []
+        for cfg, jobs in zip(config['alerts'], matched_jobs):
+            key = json.dumps([cfg, config.get('palette')], sort_keys=True)
+            job_ids = {id(job) for job in jobs}
+            alert = next((alert for alert in previous_alerts.get(key, [])
+                          if {id(job) for job in alert.jobs} == job_ids), None)
+            if alert:
+                previous_alerts[key].remove(alert)
+                alert_cfgs.append((key, alert))
+            else:
+                alert_cfgs.append((key, None))
+                new_cfgs.append((cfg, jobs))
+        self._palette = make_palette(config.get('palette'))
+        new_alerts = iter([self.create_alert(cfg, lights, jobs, self._create_missing_lights, self._hue_controller)
+                           for cfg, jobs in new_cfgs])
+        alert_cfgs = [(key, alert or next(new_alerts)) for key, alert in alert_cfgs]
+        return config, alert_cfgs, virtual_lights, jenkinses
+
+    def _swap_alerts(self, config, alert_cfgs, virtual_lights, jenkinses):
+        """
+        Replaces the current alerts with a set built by _build_alerts.
+        """
+        self._alert_keys = { id(alert) : key for key, alert in alert_cfgs }
+        for _, alert in alert_cfgs:
+            if alert not in self.alerts:
+                # the jobs may have been polled since the alert was built,
+                # and only the current alerts were told about it
+                for job in alert.jobs:
+                    alert.job_changed(job)
+        if self._state_store:
+            for key, alert in alert_cfgs:
+                if alert.first_update:
+                    self._restore_alert(key, alert)
+        alerts = [alert for _, alert in alert_cfgs]
+        kept = len([alert for alert in alerts if alert in self.alerts])
+        print("Kept {} and created {} alerts".format(kept, len(alerts) - kept))
         for alert in self.alerts:
-            alert.update()
+            if alert not in alerts:
+                # new alerts on the same lights set their own effects
+                for light in alert.lights:
+                    self._effects.clear(light)
+
+        # snapshot of the jobs to fetch each poll cycle, each job only once
+        self._watched_jobs = unique_jobs(job for alert in alerts for job in alert.jobs)
+        print("Watching {} unique jobs".format(len(self._watched_jobs)))
+        self._bulk_sources = jenkinses if self._bulk_fetch else []
+        self._scheduler.schedule(self._poll_units(self._watched_jobs, self._bulk_sources))
+        self._alerts_by_job = {}
+        for alert in alerts:
+            for job in alert.jobs:
+                self._alerts_by_job.setdefault(id(job), []).append(alert)
+        self._virtual_lights = virtual_lights
+        self._alert_cfgs = alert_cfgs
+        self.alerts = alerts
+        self.cfg = config
+
+    def _poll_units(self, jobs, bulk_sources):
+        """
+        Each jenkins polled in bulk is one unit with the watched top level
+        jobs on it, all other jobs are polled one by one.
+        """
+        units = []
+        bulk_jobs = set()
+        for source in bulk_sources:
+            top_level = {id(job) for job in source.jobs.values()}
+            covered = [job for job in jobs if id(job) in top_level]
+            if covered:
+                bulk_jobs.update(id(job) for job in covered)
+                units.append(PollUnit(source, covered))
+        units += [PollUnit(job, [job]) for job in jobs if id(job) not in bulk_jobs]
+        return units
+
+    def _restore_alert(self, key, alert):
+        """
+        Shows the stored status of an alert right away, if the state of all
+        its jobs was stored too.
+        """
+        status = self._state_store.alert_status(key)
+        if status and all(job.version for job in alert.jobs):
+            alert.restore_status(status)
+            alert.evaluate()
+
+    def _refresh_jenkinses(self):
+        """
+        Rereads the jobs and views of each jenkins, keeping the Jenkins
+        objects so that their cached view members survive a reload.
+        """
+        if not self._jenkinses:
+            self._jenkinses = [Jenkins(ip, self._job_registry) for ip in self._jenkins_ips]
+        else:
+            for jenkins in self._jenkinses:
+                jenkins.refresh()
+        return self._jenkinses
+
+    def _lights(self, config):
+        """
+        Returns all lights and the configured virtual lights by name, reusing
+        existing light objects so that they keep their state.
+        """
+        virtual_lights = {}
+        for args in config['virtual_lights']:
+            light = self._virtual_lights.get(args['name'])
+            if not light or light._debug_prints != args['enable_debug_print']:
+                light = Light(**args)
+            virtual_lights[args['name']] = light
+
+        names = {light.name for light in self._hue_controller.lights} | set(virtual_lights)
+        for cfg in config['alerts']:
+            light_names = cfg['light'] if isinstance(cfg['light'], list) else [cfg['light']]
+            if not names.issuperset(light_names):
+                # look for lights added to the bridge since last time
+                self._hue_controller.update_lights()
+                break
+        return self._hue_controller.lights + list(virtual_lights.values()), virtual_lights
+
+    def update_alerts(self):
+        """
+        Polls all watched jobs and updates the alerts.
+        """
+        # a reload may swap in new alerts while polling
+        with self._lock:
+            watched_jobs, bulk_sources = self._watched_jobs, self._bulk_sources
+        self._poll(watched_jobs, bulk_sources)
+
+    def update_due_jobs(self):
+        """
+        Polls the jobs that are due according to the poll scheduler and
+        updates the alerts watching them.
+        """
+        units = self._scheduler.due()
+        if not units:
+            return
+        jobs = unique_jobs(job for unit in units for job in unit.jobs)
+        bulk_sources = [unit.target for unit in units if isinstance(unit.target, Jenkins)]
+        try:
+            self._poll(jobs, bulk_sources)
+        finally:
+            self._scheduler.polled(units)
+
+    def wait_for_due_jobs(self, timeout=None):
+        """
+        Blocks until jobs are due to be polled, or timeout seconds.
+        """
+        self._scheduler.wait(timeout)
+
+    def _poll(self, jobs, bulk_sources):
+        start = time.monotonic()
+        deadline = None
+        if self._cycle_timeout:
+            deadline = start + self._cycle_timeout
+        self._poller.update(jobs, bulk_sources, deadline)
+        # a job that could not be fetched yet has no state to show
+        self._polled_jobs.update(id(job) for job in jobs if job.version or not job.unknown)
+        with self._lock:
+            changed_alerts = self._changed_alerts(jobs)
+            # lamps that were out of range are set again
+            reconnected = set(self._hue_controller.print_connection_status_updates())
+            for alert in self.alerts:
+                if alert.first_update:
+                    # wait until all jobs of a new alert have been polled
+                    if all(id(job) in self._polled_jobs for job in alert.jobs):
+                        self._evaluate(alert)
+                elif alert in changed_alerts or self._has_any_light(alert, reconnected):
+                    self._evaluate(alert)
+            # send what the bridge refused again, see HueLight._forget
+            for light in {id(light) : light for alert in self.alerts for light in alert.lights}.values():
+                light.commit()
+        duration = metrics.cycle_seconds.observe(time.monotonic() - start)
+        if self._cycle_timeout and duration > self._cycle_timeout:
+            metrics.cycle_overruns.inc()
+
+    def _has_any_light(self, alert, lights):
+        for light in alert.lights:
+            members = light.lights if isinstance(light, HueLightGroup) else [light]
+            if any(member in lights for member in members):
+                return True
+        return False
+
+    def _evaluate(self, alert):
+        status = alert.last_status
+        alert.evaluate()
+        if self._state_store and alert.last_status != status:
+            self._state_store.save_alert_status(self._alert_keys[id(alert)], alert.last_status)
+
+    def _changed_alerts(self, jobs):
+        """
+        Tells the alerts watching each job that has changed state since last
+        time about it, and returns those alerts.
+        """
+        changed_alerts = set()
+        changed_jobs = []
+        for job in jobs:
+            if self._job_versions.get(id(job)) == job.version:
+                continue
+            self._job_versions[id(job)] = job.version
+            changed_jobs.append(job)
+            for alert in self._alerts_by_job.get(id(job), []):
+                alert.job_changed(job)
+                changed_alerts.add(alert)
+        if self._state_store:
+            self._state_store.save_jobs(changed_jobs)
+        return changed_alerts
+
+    def on_notification(self, notification):
+        """
+        Has the job of a jenkins build notification polled right away. It is
+        polled by the poll loop like any other job, so that the request limits
+        hold and a job is never updated from two threads at once.
+        """
+        job = self._find_notified_job(notification)
+        if job:
+            self._scheduler.poll_now(job)
+
+    def _find_notified_job(self, notification):
+        url = job_url_of(notification)
+        if url:
+            url = url.rstrip('/')
+            return next((job for job in self._watched_jobs if job.url.rstrip('/') == url), None)
+        # relative url only, e.g. job/name/
+        relative_url = '/' + notification.get('url', '').strip('/')
+        if relative_url == '/':
+            return None
+        return next((job for job in self._watched_jobs if job.url.rstrip('/').endswith(relative_url)), None)
 
     def _load_config(self, cfg_file_name):
         schema_dir = path.realpath(
@@ -46,35 +379,61 @@ class Runner():
         else:
             if 'virtual_lights' not in config:
                 config['virtual_lights'] = []
-            self.cfg = config
+            return config
+
+    def _match_alert_jobs(self, alert_cfgs, jenkinses):
+        """
+        Returns the jobs monitored by each alert config, matching the jobs of
+        all alerts in a single pass over each jenkins.
+        """
+        matcher = JobMatcher()
+        for i, alert_cfg in enumerate(alert_cfgs):
+            matcher.add(i, alert_cfg['jobs_to_watch'], alert_cfg.get('jobs_to_ignore', []))
+        matched_jobs = [jenkins.match_jobs(matcher) for jenkins in jenkinses]
 
-    def create_alert(self, alert_cfg, lights, jenkinses, create_missing_lights=False):
         monitored_jobs = []
+        for i in range(len(alert_cfgs)):
+            jobs = unique_jobs(job for matched in matched_jobs for job in matched.get(i, []))
+            monitored_jobs.append([job for job in jobs if not matcher.is_ignored(i, job.name)])
+        return monitored_jobs
+
+    def create_alert(self, alert_cfg, lights, monitored_jobs, create_missing_lights=False,
+                     hue_controller=None):
+        light_names = alert_cfg['light']
+        if isinstance(light_names, str):
+            light_names = [light_names]
+        light_string = ",".join(light_names)
         num_ignored_fails = alert_cfg.get('num_ignored_fails', 0)
         ignored_jobs = alert_cfg.get('jobs_to_ignore', [])
 
-        for name in alert_cfg['jobs_to_watch']:
-            for jenkins in jenkinses:
-                monitored_jobs += jenkins.get_jobs(name)
-
-        monitored_jobs = [job for job in monitored_jobs if not any(ignored in job.name for ignored in ignored_jobs)]
-
         if monitored_jobs and len(monitored_jobs) <= 1:
             job_string = monitored_jobs[0]
         else:
             job_string = len(monitored_jobs)
-        print("{} watches {} jobs and allows {} fails".format(alert_cfg['light'], job_string, num_ignored_fails))
+        print("{} watches {} jobs and allows {} fails".format(light_string, job_string, num_ignored_fails))
         if ignored_jobs:
-            print("{} explicitly ignores {}".format(alert_cfg['light'], ",".join(ignored_jobs)))
+            print("{} explicitly ignores {}".format(light_string, ",".join(ignored_jobs)))
+
+        alert_lights = [self._find_light(name, lights, create_missing_lights) for name in light_names]
+        hue_lights = [l for l in alert_lights if isinstance(l, HueLight)]
+        if hue_controller and len(hue_lights) > 1:
+            # one group command instead of one command per light
+            group = hue_controller.group_for(hue_lights)
+            if group:
+                alert_lights = [group] + [l for l in alert_lights if not isinstance(l, HueLight)]
 
-        light = next((l for l in lights if l.name==alert_cfg['light']), None)
+        alert = Alert(alert_lights, monitored_jobs, num_ignored_fails,
+                      self._palette, self._effects)
+        return alert
+
+    def _find_light(self, name, lights, create_missing_lights):
+        light = next((l for l in lights if l.name==name), None)
         if not light:
-            print("Configured light {} does not exist".format(alert_cfg['light']))
+            print("Configured light {} does not exist".format(name))
             if not create_missing_lights:
                 print("Available lights: {}".format(', '.join((l.name for l in lights))))
-                exit(1)
-            print("Creating virtual light {}".format(alert_cfg['light']))
-            light = Light(name=alert_cfg['light'], enable_debug_print=True)
-
-        alert = Alert([light], monitored_jobs, num_ignored_fails)
-        return alert
+                # fatal on the first load only, a reload keeps the current alerts
+                raise ValueError("Configured light {} does not exist".format(name))
+            print("Creating virtual light {}".format(name))
+            light = Light(name=name, enable_debug_print=True)
+        return light
@@ -0,0 +1,44 @@
+import json
+import sqlite3
+from threading import Lock
+
+class StateStore():
+    """
+    Keeps the last known state of jobs and alerts in an SQLite file, so that
+    lamps can show the previous state right away after a restart and jobs
+    can be refreshed incrementally. Only changed rows are written.
+    """
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = Lock()
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                url TEXT PRIMARY KEY, state TEXT NOT NULL)""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS alerts (
+                key TEXT PRIMARY KEY, status TEXT NOT NULL)""")
+
+    def job_state(self, url):
+        with self._lock:
+            row = self._db.execute("SELECT state FROM jobs WHERE url = ?", (url,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_jobs(self, jobs):
+        rows = [(job.url, json.dumps(job.state)) for job in jobs]
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO jobs (url, state) VALUES (?, ?)", rows)
+
+    def alert_status(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT status FROM alerts WHERE key = ?", (key,)).fetchone()
+        return tuple(json.loads(row[0])) if row else None
+
+    def save_alert_status(self, key, status):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO alerts (key, status) VALUES (?, ?)",
+                             (key, json.dumps(status)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
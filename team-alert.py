@@ -1,33 +1,40 @@
 import argparse
-import sched, time
+import time
 import syslog
 from runner import Runner
 
-class PeriodicScheduler(sched.scheduler):
-    def enter_periodic(self, interval, func, initial_delay=None, prio=1):
-        args = {'func':func, 'interval':interval, 'prio':prio}
-        if initial_delay:
-            self.enter(initial_delay, prio, self.enter_periodic, kwargs=args)
-        else:
-            func()
-            self.enter(interval, prio, self.enter_periodic, kwargs=args)
-
-
 parser = argparse.ArgumentParser()
 parser.add_argument("alerts_cfg",type=str, help="Json configuration file")
 parser.add_argument("huebridge", help="ip of the Philips Hue Bridge")
 parser.add_argument("jenkins", nargs='+', help="url of a jenkins server")
-parser.add_argument("--poll_rate", default=10, type=int, help="seconds delay between each update")
+parser.add_argument("--poll_rate", default=10, type=int, help="seconds delay between each update of jobs that are building or have changed recently")
+parser.add_argument("--max_poll_rate", default=600, type=int, help="seconds delay between each update of jobs that have been idle for long")
+parser.add_argument("--max_requests_per_second", default=10, type=float, help="max number of jobs polled per second on each jenkins server")
 parser.add_argument("--cfg_poll_rate", default=3600, type=int, help="seconds delay between each refresh off the config file")
+parser.add_argument("--claim_poll_rate", default=60, type=int, help="seconds delay between rechecking the claim of an unchanged failed build")
+parser.add_argument("--max_requests_per_host", default=4, type=int, help="max number of simultaneous requests, and kept-alive connections, towards each jenkins server")
+parser.add_argument("--bulk_fetch", action='store_true', help="fetch the status of all top level jobs on a jenkins server with a single request")
+parser.add_argument("--notification_port", type=int, help="listen for jenkins build notifications (Notification plugin, JSON over HTTP) on this port")
+parser.add_argument("--state_file", type=str, help="file to keep the last known job and lamp state in between restarts")
+parser.add_argument("--metrics_port", type=int, help="serve prometheus metrics on http://<metrics_host>:<port>/metrics")
+parser.add_argument("--metrics_host", default='127.0.0.1', help="address to serve the metrics on, e.g. 0.0.0.0 for all interfaces")
 parser.add_argument("--create_missing_lights", action='store_true', help="create virtual lights for all configurated light that don't exist")
 args = parser.parse_args()
 
 syslog.syslog('team-alert initializing...')
-runner = Runner(args.alerts_cfg, args.huebridge, args.jenkins, args.create_missing_lights)
-            
-print("Updating status every {} sek".format(args.poll_rate))
+runner = Runner(args.alerts_cfg, args.huebridge, args.jenkins, args.create_missing_lights,
+                args.max_requests_per_host, args.bulk_fetch, args.claim_poll_rate,
+                cycle_timeout=args.poll_rate, notification_port=args.notification_port,
+                state_file=args.state_file, metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                poll_interval=args.poll_rate, max_poll_interval=args.max_poll_rate,
+                max_requests_per_second=args.max_requests_per_second)
+
+print("Updating status every {} to {} sek".format(args.poll_rate, args.max_poll_rate))
 print("Reloading config every {} sek".format(args.cfg_poll_rate))
-scheduler = PeriodicScheduler(time.time, time.sleep)
-scheduler.enter_periodic(args.cfg_poll_rate, runner.restart, args.cfg_poll_rate)
-scheduler.enter_periodic(args.poll_rate, runner.update_alerts)
-scheduler.run()
+next_reload = time.monotonic() + args.cfg_poll_rate
+while True:
+    runner.update_due_jobs()
+    if time.monotonic() >= next_reload:
+        runner.restart()
+        next_reload += args.cfg_poll_rate
+    runner.wait_for_due_jobs(max(0, next_reload - time.monotonic()))
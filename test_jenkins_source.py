@@ -0,0 +1,171 @@
+import socket
+import time
+import unittest
+import zlib
+from threading import Thread
+from unittest import mock
+import jenkins_source
+from jenkins_source import NOT_MODIFIED, FetchError, HttpPool, JenkinsJob, _fetch_data
+from retry import CircuitBreaker, RetryPolicy
+
+class FetchDataBreakerTest(unittest.TestCase):
+    """
+    A half-open trial granted by the circuit breaker must always be settled,
+    otherwise the host is refused for good.
+    """
+    def setUp(self):
+        self.url = 'http://breaker-test.invalid/job/A/'
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        jenkins_source._circuit_breakers['breaker-test.invalid'] = breaker
+        self.breaker = breaker
+        patcher = mock.patch.object(jenkins_source, 'retry_policy', RetryPolicy(tries=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(jenkins_source._circuit_breakers.pop, 'breaker-test.invalid', None)
+
+    def test_passed_deadline_does_not_take_the_trial(self):
+        with self.assertRaises(FetchError):
+            _fetch_data(self.url, deadline=time.monotonic() - 1)
+        self.assertTrue(self.breaker.allow())
+
+    def test_bad_gzip_body_settles_the_trial(self):
+        with mock.patch.object(jenkins_source.http_pool, 'get', side_effect=zlib.error('bad')):
+            with self.assertRaises(FetchError):
+                _fetch_data(self.url)
+        time.sleep(0.02)
+        self.assertTrue(self.breaker.allow())
+
+    def test_unexpected_error_settles_the_trial(self):
+        with mock.patch.object(jenkins_source.http_pool, 'get', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                _fetch_data(self.url)
+        time.sleep(0.02)
+        self.assertTrue(self.breaker.allow())
+
+    def test_success_closes_the_breaker(self):
+        with mock.patch.object(jenkins_source.http_pool, 'get', return_value=b'{"name": "A"}'):
+            self.assertEqual(_fetch_data(self.url), {'name' : 'A'})
+        self.assertFalse(self.breaker.is_open)
+
+
+class JobNotModifiedTest(unittest.TestCase):
+    """
+    Job data that jenkins reports as not modified is not parsed again, only
+    the claim of a failed build is still rechecked.
+    """
+    def setUp(self):
+        self.job = JenkinsJob('http://not-modified.invalid/job/A/', 'A', claim_recheck_interval=0)
+        self.job.update_from_data({
+            'builds' : [{ 'number' : 4 }, { 'number' : 5 }],
+            'lastFailedBuild' : { 'number' : 5 },
+            'lastStableBuild' : { 'number' : 4 },
+            'lastCompletedBuild' : { 'number' : 5, 'actions' : [{ 'claimed' : False }] },
+        })
+        self.addCleanup(jenkins_source._circuit_breakers.pop, 'not-modified.invalid', None)
+
+    def test_unchanged_job_keeps_its_state(self):
+        self.job.mark_unknown('test')
+        version = self.job.version
+        with mock.patch.object(jenkins_source, '_fetch_data',
+                               side_effect=[NOT_MODIFIED, { 'number' : 5, 'actions' : [{}] }]) as fetch:
+            self.job.update()
+        self.assertEqual(fetch.call_args_list[0].kwargs['conditional'], True)
+        self.assertEqual(fetch.call_args_list[1].args[0], 'http://not-modified.invalid/job/A/5')
+        self.assertFalse(self.job.unknown)
+        self.assertEqual(self.job.version, version)
+        self.assertFalse(self.job.ok())
+
+    def test_claim_of_unchanged_job_is_rechecked(self):
+        version = self.job.version
+        with mock.patch.object(jenkins_source, '_fetch_data',
+                               side_effect=[NOT_MODIFIED, { 'number' : 5, 'actions' : [{ 'claimed' : True }] }]):
+            self.job.update()
+        self.assertTrue(self.job.claimed)
+        self.assertEqual(self.job.version, version + 1)
+
+    def test_not_modified_is_not_parsed(self):
+        with mock.patch.object(jenkins_source.http_pool, 'get', return_value=NOT_MODIFIED):
+            self.assertIs(_fetch_data(self.job.url, conditional=True), NOT_MODIFIED)
+
+
+class JobBuildsTest(unittest.TestCase):
+    """
+    Only the oldest of the newest builds is fetched, or the first build if
+    there are fewer.
+    """
+    def job_failing_since(self, data):
+        job = JenkinsJob('http://builds.invalid/job/A/', 'A')
+        data.update({
+            'lastFailedBuild' : { 'number' : 150 },
+            'lastStableBuild' : None,
+            'lastCompletedBuild' : { 'number' : 150 },
+        })
+        job.update_from_data(data)
+        return job.nr_times_same_state
+
+    def test_oldest_of_newest_builds(self):
+        self.assertEqual(self.job_failing_since({ 'builds' : [{ 'number' : 51 }], 'firstBuild' : { 'number' : 1 } }), 99)
+
+    def test_first_build_when_there_are_fewer(self):
+        self.assertEqual(self.job_failing_since({ 'builds' : [], 'firstBuild' : { 'number' : 120 } }), 30)
+
+    def test_never_built(self):
+        self.assertEqual(self.job_failing_since({ 'builds' : [], 'firstBuild' : None }), 0)
+
+
+class HttpPoolRetryTest(unittest.TestCase):
+    """
+    Only a kept-alive connection the server has closed is retried on a new
+    connection, anything else is left to the retry policy of _fetch_data.
+    """
+    def setUp(self):
+        self.requests = 0
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.addCleanup(self.server.close)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.getsockname()[1])
+        self.pool = HttpPool(timeout=0.2)
+        self.addCleanup(self.pool.close)
+
+    def serve(self, close_after_response):
+        def handle(conn):
+            with conn:
+                while conn.recv(4096):
+                    self.requests += 1
+                    if self.requests == 1:
+                        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+                        if close_after_response:
+                            return
+                    elif close_after_response:
+                        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n[]')
+                    # otherwise later requests are never answered
+        def accept():
+            while True:
+                try:
+                    conn, _ = self.server.accept()
+                except OSError:
+                    return
+                Thread(target=handle, args=(conn,), daemon=True).start()
+        Thread(target=accept, daemon=True).start()
+
+    def test_closed_idle_connection_is_retried(self):
+        self.serve(close_after_response=True)
+        self.assertEqual(self.pool.get(self.url), b'{}')
+        time.sleep(0.05)
+        self.assertEqual(self.pool.get(self.url), b'[]')
+
+    def test_timeout_is_not_retried(self):
+        self.serve(close_after_response=False)
+        self.pool.get(self.url)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.pool.get(self.url)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(self.requests, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import re
+import unittest
+from job_matcher import JobMatcher
+
+class JobMatcherTest(unittest.TestCase):
+    """
+    The combined expression may only reject names that no single pattern
+    matches.
+    """
+    def assert_matches_like_re(self, patterns, names):
+        matcher = JobMatcher()
+        for i, pattern in enumerate(patterns):
+            matcher.add(i, [pattern])
+        for name in names:
+            expected = {i for i, pattern in enumerate(patterns) if re.match(pattern + '$', name)}
+            self.assertEqual(matcher.match(name), expected, name)
+
+    def test_back_references(self):
+        self.assert_matches_like_re([r'(a)\1', r'(b)\1'], ['aa', 'bb', 'ab', 'b'])
+
+    def test_named_groups(self):
+        self.assert_matches_like_re([r'(?P<x>a)(?P=x)', r'(?P<x>b)(?P=x)', r'(?P<y>c)d'], ['aa', 'bb', 'cd', 'cc'])
+
+    def test_groups_without_references(self):
+        self.assert_matches_like_re([r'(team|squad)-.*', r'build-(\d+)'], ['team-a', 'build-12', 'build-x', 'other'])
+
+
+if __name__ == "__main__":
+    unittest.main()
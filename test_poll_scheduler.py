@@ -0,0 +1,46 @@
+import unittest
+from poll_scheduler import PollScheduler, PollUnit
+
+class FakeJob():
+    url = 'http://jenkins.invalid/job/A/'
+    building = False
+    unknown = False
+    version = 1
+    last_build_time = None
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def test_unit_rescheduled_while_polled_is_kept(self):
+        job = FakeJob()
+        scheduler = PollScheduler(fast_interval=0.1, slow_interval=1)
+        scheduler.schedule([PollUnit(job, [job])])
+        units = scheduler.due()
+        # a reload replaces the unit while it is being polled
+        scheduler.schedule([PollUnit(job, [job])])
+        scheduler.polled(units)
+        self.assertEqual(len(scheduler._entries), 1)
+        self.assertEqual(scheduler.due(), [])
+
+    def test_poll_now_makes_unit_due(self):
+        job = FakeJob()
+        scheduler = PollScheduler(fast_interval=10, slow_interval=10)
+        scheduler.schedule([PollUnit(job, [job])])
+        scheduler.polled(scheduler.due())
+        self.assertEqual(scheduler.due(), [])
+        scheduler.poll_now(job)
+        self.assertEqual([unit.target for unit in scheduler.due()], [job])
+
+    def test_poll_now_while_polled_polls_again(self):
+        job = FakeJob()
+        scheduler = PollScheduler(fast_interval=10, slow_interval=10)
+        scheduler.schedule([PollUnit(job, [job])])
+        units = scheduler.due()
+        scheduler.poll_now(job)
+        scheduler.polled(units)
+        self.assertEqual([unit.target for unit in scheduler.due()], [job])
+        scheduler.polled(units)
+        self.assertEqual(scheduler.due(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()